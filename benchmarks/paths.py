@@ -0,0 +1,73 @@
+"""
+Microbenchmarks for PathFactory, against the previous digit-at-a-time implementation
+
+    python -m benchmarks.paths
+"""
+import collections
+import timeit
+import typing
+
+from django_ltree_utils.paths import PathFactory
+
+
+class DigitPathFactory(PathFactory):
+    # The encode/decode (and encoding ranges label by label) that PathFactory replaced,
+    # kept for comparison
+
+    def encode(self, value: int) -> str:
+        if value < 0:
+            raise ValueError
+
+        d: typing.Deque[str] = collections.deque()
+
+        appendleft = d.appendleft
+        alphabet = self.alphabet
+
+        while value:
+            value, rem = divmod(value, self.base)
+            appendleft(alphabet[rem])
+
+        if len(d) > self.max_length:
+            raise ValueError(f"Cannot encode fixed-length base-{self.base}: {value!r}")
+
+        return ''.join(d).zfill(self.max_length)
+
+    def decode(self, chars: str) -> int:
+        total = 0
+        radix = 1
+
+        for digit in map(self.reverse.__getitem__, chars[::-1]):
+            total += digit * radix
+            radix *= self.base
+
+        return total
+
+    def encode_range(self, start: int, stop: int, step: int = 1) -> typing.Iterator[str]:
+        # Otherwise the new encode_range would be measured, which doesn't call self.encode
+        return map(self.encode, range(start, stop, step))
+
+
+def main():
+    small = list(range(1000))
+    large = list(range(10_000_000, 10_001_000))
+
+    for factory in [DigitPathFactory(), PathFactory()]:
+        name = factory.__class__.__name__
+
+        labels = [factory.encode(value) for value in large]
+
+        cases = {
+            'encode small': lambda: [factory.encode(value) for value in small],
+            'encode large': lambda: [factory.encode(value) for value in large],
+            'decode': lambda: [factory.decode(label) for label in labels],
+            'nth_child': lambda: [factory.nth_child(['0000'], n) for n in small],
+            'encode_range': lambda: list(factory.encode_range(10_000_000, 10_001_000)),
+        }
+
+        for case, func in cases.items():
+            seconds = min(timeit.repeat(func, number=100, repeat=5)) / 100
+            print(f'{name:18} {case:14} {seconds * 1_000_000:10.1f} us / 1000 labels')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Compare assembling trees with tree_iterator against the previous recursive implementation
+
+    python -m benchmarks.tree_assembly
+"""
+from functools import partial
+import itertools as it
+import operator as op
+import timeit
+
+from django.utils.functional import cached_property
+
+from django_ltree_utils.paths import PathFactory
+from django_ltree_utils.trees import tree_iterator
+
+
+def recursive_tree_iterator(queryset, path_field='path'):
+    # The implementation tree_iterator replaced, kept for comparison
+    # Each root buffers its descendants, and children re-runs this over them
+
+    iterator = iter(queryset)
+
+    if isinstance(path_field, str):
+        path_getter = op.attrgetter(path_field)
+    else:
+        path_getter = path_field
+
+    while True:
+        try:
+            root = next(iterator)
+        except StopIteration:
+            break
+
+        root._tree_iterator = partial(recursive_tree_iterator, path_field=path_getter)
+
+        parent_path = path_getter(root)
+
+        root.depth = len(parent_path)
+        root.descendants = []
+
+        for node in iterator:
+
+            path = path_getter(node)
+
+            node.depth = len(path)
+
+            if node.depth > root.depth:
+                root.descendants.append(node)
+            else:
+                # Shift the element back on to the front
+                iterator = it.chain([node], iterator)
+                break
+
+        yield root
+
+
+class Node:
+    # Stand-in for the previous AbstractNode, without the database
+    def __init__(self, path):
+        self.path = path
+
+    @cached_property
+    def children(self):
+        return self._tree_iterator(self.descendants)
+
+
+def deep_tree(depth, breadth):
+    # breadth chains of depth nodes each
+    factory = PathFactory()
+
+    for i in range(breadth):
+        path = factory.nth_child([], i)
+        yield path
+
+        for _ in range(depth - 1):
+            path = factory.nth_child(path, 0)
+            yield path
+
+
+def wide_tree(breadth):
+    # One root with breadth children
+    factory = PathFactory()
+    root = factory.nth_child([], 0)
+
+    yield root
+
+    for i in range(breadth):
+        yield factory.nth_child(root, i)
+
+
+def visit(nodes):
+    # Touch every node, like rendering the tree would
+    count = 0
+
+    for node in nodes:
+        count += 1 + visit(node.children)
+
+    return count
+
+
+def recursive(paths):
+    return visit(recursive_tree_iterator(map(Node, paths), path_field='path'))
+
+
+def single_pass(paths):
+    return visit(tree_iterator(map(Node, paths), path_field='path'))
+
+
+def main():
+    shapes = {
+        'deep (10 x 500 levels)': list(deep_tree(500, 10)),
+        'wide (1 x 10,000 children)': list(wide_tree(10000)),
+        'bushy (10^4 nodes, 4 levels)': [
+            list(path) for path in it.chain.from_iterable(
+                it.product(*([PathFactory().encode(i) for i in range(10)],) * depth)
+                for depth in range(1, 5)
+            )
+        ],
+    }
+
+    for name, paths in shapes.items():
+        paths.sort()
+
+        assert recursive(paths) == single_pass(paths) == len(paths)
+
+        for func in [recursive, single_pass]:
+            seconds = min(timeit.repeat(lambda: func(paths), number=1, repeat=3))
+            print(f'{name:32} {func.__name__:12} {seconds * 1000:10.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,81 +1,198 @@
+import collections
 import copy
+import datetime
+import decimal
 from functools import reduce
-from functools import partial
+import io
 import itertools as it
 import operator as op
+import random
+import time
 import typing
+import uuid
 
-from django.db import models
+from django.core.exceptions import EmptyResultSet
+from django.db import IntegrityError, OperationalError, connections, models, router, transaction
 from django.db.models import Case, When, Value, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.query import FlatValuesListIterable, ModelIterable, ValuesIterable
 from django_ltree_field.fields import LTreeField
 from django_ltree_field.functions import Concat, Subpath
+from psycopg2.extensions import Binary
 
-from .paths import Path, PathFactory
+from .paths import FractionalPathFactory, Path, PathFactory
 from .position import RelativePosition, SortedPosition
+from .sql import decode_sql, encode_sql, function_name
+from .trees import TreeNode, tree_iterator
+
+
+def _copy_literal(value) -> str:
+    # PostgreSQL's text input syntax for a value prepared by a field, before COPY's escaping
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, (str, int, float, decimal.Decimal, uuid.UUID, datetime.date, datetime.time)):
+        return str(value)
+    elif isinstance(value, datetime.timedelta):
+        # str() would be e.g. '1 day, 0:00:00', which isn't an interval
+        return f'{value.days} days {value.seconds} seconds {value.microseconds} microseconds'
+    elif isinstance(value, Binary):
+        # What BinaryField prepares its bytes as
+        return _copy_literal(value.adapted)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    elif isinstance(value, (list, tuple)):
+        # Array literal, with every element quoted
+        items = []
+
+        for item in value:
+            if item is None:
+                items.append('NULL')
+            elif isinstance(item, (list, tuple)):
+                items.append(_copy_literal(item))
+            else:
+                items.append('"' + _copy_literal(item).replace('\\', '\\\\').replace('"', '\\"') + '"')
 
+        return '{' + ','.join(items) + '}'
 
-def tree_iterator(queryset, path_field='path'):
-    # This will very much break if the tree is not in a good state
+    # e.g. dicts for hstore, or psycopg2's range types
+    raise TypeError(f"Cannot write {type(value).__name__} values with COPY")
 
-    iterator = iter(queryset)
 
-    if isinstance(path_field, str):
-        path_getter = op.attrgetter(path_field)
-    # Avoid calling attrgetter repeatedly
-    # Could check if it's calalble
-    else:
-        path_getter = path_field
+def _copy_text(value) -> str:
+    # Format a value for COPY's text format
+    if value is None:
+        return '\\N'
 
-    while True:
-        try:
-            root = next(iterator)
-        except StopIteration:
-            break
+    return _copy_literal(value).replace(
+        '\\', '\\\\'
+    ).replace(
+        '\t', '\\t'
+    ).replace(
+        '\n', '\\n'
+    ).replace(
+        '\r', '\\r'
+    )
 
-        # Need the path field bound?
-        root._tree_iterator = partial(tree_iterator, path_field=path_getter)
 
-        # TODO make attribute configurable here
-        parent_path = path_getter(root)
+class Shift(typing.NamedTuple):
+    """
+    Shift the labels of all children of parent from label onward by delta,
+    taking their subtrees along
+    """
+    parent: Path
+    label: str
+    delta: int
 
-        # Set properties so that the rest of the API can work
-        root.depth = len(parent_path)
-        root.descendants = []
 
-        # We should probably assert that the prefixes match up to this point
-        for node in iterator:
+class TreeQuerySet(models.QuerySet):
+    def __init__(self, *args, path_field: str = 'path', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path_field = path_field
 
-            path = path_getter(node)
+    def _path_getter(self) -> typing.Callable:
+        # Find the path in whatever kind of row this queryset returns
+        if issubclass(self._iterable_class, ModelIterable):
+            return op.attrgetter(self.path_field)
+        elif issubclass(self._iterable_class, ValuesIterable):
+            return op.itemgetter(self.path_field)
+        elif issubclass(self._iterable_class, FlatValuesListIterable):
+            return lambda row: row
+
+        # values_list(), same column order as ValuesListIterable
+        if self._fields:
+            names = [
+                *self._fields,
+                *(name for name in self.query.annotation_select if name not in self._fields)
+            ]
+        else:
+            names = [*self.query.extra_select, *self.query.values_select, *self.query.annotation_select]
 
-            node.depth = len(path)
+        return op.itemgetter(names.index(self.path_field))
 
-            # Does not set descendants
-            # That will get set by root.children property
+    def roots(self, chunk_size: typing.Optional[int] = None):
+        # With a chunk_size, rows are streamed from a server-side cursor instead of
+        # fetching the whole result set up front
+        # Each root still buffers its own subtree
+        # Rows from values() and values_list() are wrapped in TreeNode
+        return tree_iterator(
+            self if chunk_size is None else self.iterator(chunk_size=chunk_size),
+            path_field=self._path_getter(),
+            node_factory=None if issubclass(self._iterable_class, ModelIterable) else TreeNode
+        )
 
-            if node.depth > root.depth:
-                root.descendants.append(node)
+    def as_tree(self, fields: typing.Iterable[str] = ()) -> typing.List[TreeNode]:
+        """
+        Build a list of roots from values_list() rows, without instantiating any models
+        The path and the requested fields can be accessed as attributes of each node,
+        e.g. node.name and node.children
+        Fields named like the node's own attributes (row, depth and children) would be hidden
+        by them, so they're rejected
+        """
+        fields = list(fields)
+        shadowed = set(fields) & set(TreeNode.__slots__)
 
-                # Issue warning
-                # if path[:len(parent_path)] != parent_path:
-                #     pass
+        if shadowed:
+            raise ValueError(f"Fields would be shadowed by TreeNode attributes: {sorted(shadowed)!r}")
 
-            else:
-                # Shift the element back on to the front
-                iterator = it.chain([node], iterator)
-                break
+        # Rows must be in path order, whatever the queryset is ordered by
+        return list(tree_iterator(
+            self.order_by(self.path_field).values_list(self.path_field, *fields, named=True),
+            path_field=0,
+            node_factory=TreeNode
+        ))
 
-        yield root
+    def walk(self, chunk_size: int = 2000):
+        """
+        Stream (depth, node) pairs in depth-first order from a server-side cursor
+        No subtrees are built, so only one chunk of rows is held in memory at a time
+        """
+        path_getter = self._path_getter()
 
+        for node in self.order_by(self.path_field).iterator(chunk_size=chunk_size):
+            yield len(path_getter(node)), node
 
-class TreeQuerySet(models.QuerySet):
-    def __init__(self, *args, path_field: str = 'path', **kwargs):
-        super().__init__(*args, **kwargs)
-        self.path_field = path_field
+    def _subtrees_where(self, using: str) -> typing.Tuple[str, typing.Tuple]:
+        # Condition matching the nodes in this queryset and all of their descendants
+        quote_name = connections[using].ops.quote_name
 
-    def roots(self):
-        return tree_iterator(
-            self, path_field=self.path_field
-        )
+        table = quote_name(self.model._meta.db_table)
+        column = quote_name(self.model._meta.get_field(self.path_field).column)
+
+        roots, params = self.order_by().values(self.path_field).query.get_compiler(using=using).as_sql()
+
+        return f'{table}.{column} <@ ANY(ARRAY({roots}))', params
+
+    def delete_subtrees(self, signals: bool = False) -> typing.Tuple[int, typing.Dict[str, int]]:
+        """
+        Delete the nodes in this queryset along with all of their descendants
+        By default this is one DELETE statement, no matter how big the subtrees are, so like a raw
+        DELETE no signals are sent and related objects aren't collected
+        With signals, the subtrees are deleted with delete(), which loads every node
+        Returns the same as delete()
+        """
+        assert not self.query.is_sliced, "Cannot use 'limit' or 'offset' with delete_subtrees."
+
+        using = self._db or router.db_for_write(self.model, **self._hints)
+        quote_name = connections[using].ops.quote_name
+
+        table = quote_name(self.model._meta.db_table)
+
+        # Like delete(), nothing to do if the queryset is known to be empty, e.g. none()
+        try:
+            where, params = self._subtrees_where(using)
+        except EmptyResultSet:
+            return 0, {self.model._meta.label: 0}
+
+        if signals:
+            return self.model._base_manager.using(using).filter(
+                pk__in=RawSQL(f'SELECT {table}.{quote_name(self.model._meta.pk.column)} FROM {table} WHERE {where}', params)
+            ).delete()
+
+        with connections[using].cursor() as cursor:
+            cursor.execute(f'DELETE FROM {table} WHERE {where}', params)
+            count = cursor.rowcount
+
+        return count, {self.model._meta.label: count}
 
 
 class TreeManager(models.Manager):
@@ -86,6 +203,12 @@ class TreeManager(models.Manager):
                  path_field: str = 'path',
                  path_factory: typing.Optional[PathFactory] = None,
                  ordering=(),
+                 move_strategy: str = 'values',
+                 copy_threshold: typing.Optional[int] = None,
+                 lock_parents: bool = False,
+                 retries: int = 0,
+                 retry_backoff: float = 0.01,
+                 sql_functions: typing.Optional[str] = None,
                  **kwargs):
         # Default label_length of 4 allows each node to have 14,776,336 children
         # You can (but shouldn't) change this after adding rows to the database, but you must
@@ -95,13 +218,46 @@ class TreeManager(models.Manager):
         self.path_field = path_field
         # self.ordering = ordering
 
+        # How _bulk_move sends the (old_path, new_path) pairs to the database
+        # 'values' joins against the pairs as a set, 'case' builds one CASE arm per pair
+        if move_strategy not in {'case', 'values'}:
+            raise ValueError(f"Unknown move_strategy: {move_strategy!r}")
+
+        self.move_strategy = move_strategy
+        # Batches of at least this many moves are staged in a temporary table with COPY
+        # instead, which keeps the statement text and parse time constant
+        self.copy_threshold = copy_threshold
+
+        # Serialize writers to the same parent with advisory locks, instead of letting them
+        # collide on the unique constraint at commit
+        self.lock_parents = lock_parents
+
+        # Retry writes which conflict with concurrent writers this many times, sleeping for up to
+        # retry_backoff seconds, doubling every attempt
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+        # Prefix of the label functions installed with operations.CreateLabelFunctions,
+        # for the same alphabet, max_length and stride as the path factory
+        # Without them, statements inline the equivalent expressions
+        if sql_functions is not None:
+            function_name(sql_functions, '')
+
+        self.sql_functions = sql_functions
+
+        # Orderings by field names can also be evaluated by the database,
+        # callables can only be evaluated in Python
+        self._ordering_fields: typing.Optional[typing.Tuple[str, ...]] = None
+
         if ordering:
             if callable(ordering):
                 self._sort_key = ordering
             elif isinstance(ordering, str):
                 self._sort_key = op.attrgetter(ordering)
+                self._ordering_fields = (ordering,)
             else:
                 self._sort_key = op.attrgetter(*ordering)
+                self._ordering_fields = tuple(ordering)
             self.Position = SortedPosition
         else:
             self._sort_key = None
@@ -109,25 +265,42 @@ class TreeManager(models.Manager):
 
         super().__init__(*args, **kwargs)
 
-    # Recursively instantiate a tree,
+    # Instantiate a tree, without recursion,
     # with "children" set, in sorted order (if provided)
     def _init_tree(self, node, key=None):
-        children = (
-            self._init_tree(node, key=key)
-            for node in node.pop('children', [])
-        )
+        children = node.pop('children', [])
 
-        obj = self.model(
+        root = self.model(
             path=None,
             **node
         )
+        root.children = []
 
-        if key:
-            obj.children = sorted(children, key=key)
-        else:
-            obj.children = list(children)
+        # Each ancestor of the current node, with the child dicts it has left
+        stack = [(root, iter(children))]
+
+        while stack:
+            parent, children = stack[-1]
 
-        return obj
+            for node in children:
+                grandchildren = node.pop('children', [])
+
+                obj = self.model(
+                    path=None,
+                    **node
+                )
+                obj.children = []
+
+                parent.children.append(obj)
+                stack.append((obj, iter(grandchildren)))
+                break
+            else:
+                stack.pop()
+
+                if key:
+                    parent.children.sort(key=key)
+
+        return root
 
     def _get_relative_position(self, absolute_path):
 
@@ -173,77 +346,581 @@ class TreeManager(models.Manager):
 
             return self.Position.ROOT, None
 
+    @property
+    def stats(self) -> typing.Counter[str]:
+        """
+        Counts of write attempts, conflicts, retries and failures (conflicts that were given up on)
+        Only kept for writes with retries
+        """
+        # Created lazily, managers are copied to every concrete model and shouldn't share it
+        try:
+            return self._stats
+        except AttributeError:
+            self._stats: typing.Counter[str] = collections.Counter()
+            return self._stats
+
+    def _unique_path_constraint(self) -> typing.Optional[str]:
+        # Name of the deferred unique constraint on the path field, like AbstractNode has
+        for constraint in self.model._meta.constraints:
+            if (
+                isinstance(constraint, models.UniqueConstraint)
+                and constraint.deferrable is not None
+                and tuple(constraint.fields) == (self.path_field,)
+            ):
+                return constraint.name
+
+        return None
+
+    def _is_conflict(self, exc: Exception) -> bool:
+        # Serialization failures, deadlocks and violations of the unique path constraint
+        # can all be fixed by trying again
+        cause = exc.__cause__
+        pgcode = getattr(cause, 'pgcode', None)
+
+        if pgcode == '23505':
+            return getattr(getattr(cause, 'diag', None), 'constraint_name', None) == self._unique_path_constraint()
+
+        return pgcode in {'40001', '40P01'}
+
+    def _retrying(self, write: typing.Callable):
+        """
+        Call write() in a savepoint, retrying conflicts up to self.retries times with jittered
+        exponential backoff
+        write must start over from scratch every time it's called
+        """
+        if not self.retries:
+            return write()
+
+        using = self._db or router.db_for_write(self.model, **self._hints)
+        connection = connections[using]
+        quote_name = connection.ops.quote_name
+
+        constraint = self._unique_path_constraint()
+
+        for attempt in it.count():
+            self.stats['attempts'] += 1
+
+            try:
+                with transaction.atomic(using=using):
+                    result = write()
+
+                    # The deferred constraint would only be checked at commit, possibly long
+                    # after the savepoint is gone, so check it now
+                    if constraint is not None:
+                        with connection.cursor() as cursor:
+                            cursor.execute(f'SET CONSTRAINTS {quote_name(constraint)} IMMEDIATE')
+                            cursor.execute(f'SET CONSTRAINTS {quote_name(constraint)} DEFERRED')
+
+                return result
+            except (IntegrityError, OperationalError) as exc:
+                if not self._is_conflict(exc):
+                    raise
+
+                self.stats['conflicts'] += 1
+
+                if attempt >= self.retries:
+                    self.stats['failures'] += 1
+                    raise
+
+                self.stats['retries'] += 1
+
+                time.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+
+    def _lock_parents(self, parents: typing.Iterable[Path]):
+        """
+        With lock_parents, take transaction-level advisory locks before writing the children
+        of parents: exclusive for each parent, shared for each of their ancestors, since writing
+        to an ancestor (e.g. shifting its children) moves the whole subtree
+        Writers to unrelated parents don't block each other
+        Must be called inside a transaction
+        """
+        if not self.lock_parents:
+            return
+
+        exclusive: typing.Dict[typing.Tuple[str, ...], bool] = {}
+
+        for parent in parents:
+            parent = tuple(parent)
+
+            for depth in range(len(parent)):
+                exclusive.setdefault(parent[:depth], False)
+
+            exclusive[parent] = True
+
+        if not exclusive:
+            return
+
+        # Always in the same order, ancestors first, so writers can't deadlock
+        locks = sorted(exclusive.items())
+
+        connection = connections[self._db or router.db_for_write(self.model, **self._hints)]
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT {}'.format(', '.join(
+                '{}(hashtext(%s), hashtext(%s))'.format(
+                    'pg_advisory_xact_lock' if is_exclusive else 'pg_advisory_xact_lock_shared'
+                )
+                for path, is_exclusive in locks
+            )), [
+                param
+                for path, is_exclusive in locks
+                for param in [self.model._meta.db_table, '.'.join(path)]
+            ])
+
     # Could be _get_absolute_position
 
+    def _resolve(self, position_kwargs) -> typing.Tuple[Path, typing.Optional[str]]:
+        # (parent, bound) of the position, popping it off the kwargs
+        # Doesn't touch the database, so bad positions can be rejected before any transaction
+        return self.Position.resolve(
+            position_kwargs, path_field=self.path_field, path_factory=self.path_factory
+        )
+
     def _resolve_position(self, instance, position_kwargs):
         """
         Takes the kwargs and resolves it to an absolute path
         Returns typing.List[typing.Tuple[Path, Path]]
-        a list of (old_path, new_path) tuples that must first be
+        a list of (old_path, new_path) tuples (or Shift descriptors) that must first be
         moved
         """
+        parent, bound = self._resolve(position_kwargs)
+
+        return self._resolve_at(instance, parent, bound)
+
+    def _resolve_at(self, instance, parent: Path, bound: typing.Optional[str]):
+        """
+        Same as _resolve_position, with the position already resolved
+        """
         # instance is mutated
         # the path_field is set
 
-        # So we can find the instance again later
-        instance_id = instance.id
+        # A node being moved is also taken away from its current parent
+        if instance.id is not None:
+            self._lock_parents([parent, getattr(instance, self.path_field)[:-1]])
+        else:
+            self._lock_parents([parent])
 
-        parent, child_index = self.Position.resolve(
-            position_kwargs, path_field=self.path_field, path_factory=self.path_factory
-        )
+        # Without an ordering, or with an ordering the database can evaluate,
+        # only the neighbours at the insertion point matter
+        if not self._sort_key:
+            moves = self._resolve_neighbours(instance, parent, bound)
+        elif self._ordering_fields:
+            moves = self._resolve_sorted_neighbours(instance, parent)
+        else:
+            moves = None
+
+        if moves is not None:
+            return moves
 
+        return self._resolve_siblings(instance, parent, bound)
+
+    def _children(self, parent: Path):
         # Root nodes
         if parent == []:
-            queryset = self.filter(
+            return self.filter(
                 **{f'{self.path_field}__depth': 1}
             )
         else:
-            queryset = self.filter(
+            return self.filter(
                 **{f"{self.path_field}__child_of": parent}
             )
 
-        # if instance.id is not None:
-        #     children = children.exclude(id=instance.id)
+    def _sibling_paths(self, instance, parent: Path):
+        queryset = self._children(parent)
+
+        # Don't count a node that's being moved as its own neighbour
+        if instance.id is not None:
+            queryset = queryset.exclude(id=instance.id)
+
+        return queryset.values_list(self.path_field, flat=True)
 
-        queryset = queryset.order_by(self.path_field)
+    def _resolve_neighbours(self, instance, parent: Path, bound: typing.Optional[str]):
+        """
+        Assign a path to instance by only looking up its neighbours at the insertion point,
+        so the cost doesn't depend on the number of siblings
+        Returns None if the siblings must be loaded and relabeled instead
+        """
+        paths = self._sibling_paths(instance, parent)
+
+        if bound is None:
+            before, after = paths, paths.none()
+        elif bound == '':
+            before, after = paths.none(), paths
+        else:
+            bound_path = parent + [bound]
+            before = paths.filter(**{f'{self.path_field}__lt': bound_path})
+            after = paths.filter(**{f'{self.path_field}__gte': bound_path})
+
+        left = before.order_by(f'-{self.path_field}').first()
+        right = after.order_by(self.path_field).first()
+
+        return self._place(instance, parent, paths, left, right)
+
+    def _ordering_q(self, values, lookup: str) -> Q:
+        # Lexicographic comparison of the ordering fields against values
+        # lookup is applied to the last field, the strict version of it to the others
+        strict = lookup.rstrip('e')
+
+        *init, (field, value) = zip(self._ordering_fields, values)
+
+        q = Q(**{f'{field}__{lookup}': value})
+
+        for field, value in reversed(init):
+            q = Q(**{f'{field}__{strict}': value}) | (Q(**{field: value}) & q)
+
+        return q
+
+    def _resolve_sorted_neighbours(self, instance, parent: Path):
+        """
+        Assign a path to instance by looking up its neighbours according to the ordering fields,
+        so the cost doesn't depend on the number of siblings
+        Assumes the siblings' paths are already in the same order as the ordering fields,
+        as compared by the database
+        Returns None if the siblings must be loaded and relabeled instead
+        """
+        paths = self._sibling_paths(instance, parent)
+
+        values = [getattr(instance, field) for field in self._ordering_fields]
+
+        # Ties go after the existing siblings, like a stable sort
+        left = paths.filter(
+            self._ordering_q(values, 'lte')
+        ).order_by(
+            *(f'-{field}' for field in self._ordering_fields), f'-{self.path_field}'
+        ).first()
+
+        right = paths.filter(
+            self._ordering_q(values, 'gt')
+        ).order_by(
+            *self._ordering_fields, self.path_field
+        ).first()
+
+        # Neighbours which are out of order can't be fixed with a shift
+        if left is not None and right is not None and left > right:
+            return None
+
+        return self._place(instance, parent, paths, left, right)
+
+    def _place(self, instance, parent: Path, paths, left: typing.Optional[Path], right: typing.Optional[Path]):
+        """
+        Assign a path to instance between the sibling paths left and right
+        If there's no room, respace a window of siblings from right onward, or shift
+        right and all of the siblings after it
+        Returns None if the siblings must be loaded and relabeled instead
+        """
+        current_path = getattr(instance, self.path_field) if instance.id is not None else None
+
+        left = None if left is None else left[-1]
+        right = None if right is None else right[-1]
+
+        # Already between the neighbours, so it can stay where it is
+        if current_path and self._fits(current_path, parent, left, right):
+            return []
+
+        # Common case, there's room between the neighbours
+        label = self.path_factory.between(left, right)
+
+        if label is not None:
+            setattr(instance, self.path_field, parent + [label])
+            return []
+
+        # Nothing to shift out of the way, the siblings need relabeling
+        if right is None:
+            return None
+
+        moves = self._respace_window(instance, parent, paths, left, right)
+
+        if moves is not None:
+            return moves
+
+        # A node being moved from the range that would be shifted can't be
+        # shifted and moved in separate statements without colliding
+        depth = len(parent)
+
+        if current_path and current_path[:depth] == parent and current_path[depth:depth + 1] >= [right]:
+            return None
+
+        # Shift the right neighbour and everything after it by one stride
+        # to open up a gap
+        delta = self.path_factory.stride
+        last = paths.order_by(f'-{self.path_field}').first()[-1]
+
+        try:
+            # Make sure the last sibling doesn't overflow
+            self.path_factory.encode(self.path_factory.decode(last) + delta)
+        except ValueError:
+            return None
+
+        shifted = self.path_factory.encode(self.path_factory.decode(right) + delta)
+
+        setattr(instance, self.path_field, parent + [self.path_factory.between(left, shifted)])
+
+        return [
+            Shift(parent, right, delta)
+        ]
+
+    def _sibling_snapshot(self, parents: typing.Iterable[typing.Tuple[str, ...]], exclude: typing.Optional[Q] = None):
+        """
+        Load the children of every parent in one query, ordered by path
+        Returns a dict of parent -> list of children
+        """
+        queryset = self.filter(
+            reduce(op.or_, (
+                Q(**{f'{self.path_field}__child_of': list(parent)})
+                if parent else Q(**{f'{self.path_field}__depth': 1})
+                for parent in parents
+            ))
+        ).order_by(self.path_field)
+
+        if exclude is not None:
+            queryset = queryset.exclude(exclude)
 
         # If we don't have a specified ordering,
         # we don't need all of the columns, just these two
         if not self._sort_key:
-            queryset = queryset.only(
-                'id', self.path_field
-            )
+            queryset = queryset.only('id', self.path_field)
+
+        siblings: typing.Dict[typing.Tuple[str, ...], typing.List] = {parent: [] for parent in parents}
 
-        current_pos = None
-        children = []
+        for child in queryset:
+            siblings[tuple(getattr(child, self.path_field)[:-1])].append(child)
+
+        return siblings
+
+    def _insert_at_bound(self, children, instance, bound: typing.Optional[str], placed: typing.AbstractSet[int] = frozenset()):
+        # Insert instance before the first child at or after the bound
+        # None is last index
+        # Children in placed (by id()) were inserted already, and don't have a
+        # label to compare yet, so anything with the same bound goes after them
+        child_index = len(children)
+
+        if bound is not None:
+            for i, child in enumerate(children):
+                if id(child) not in placed and getattr(child, self.path_field)[-1] >= bound:
+                    child_index = i
+                    break
+
+        children.insert(child_index, instance)
+
+    def _respace_window(self, instance, parent: Path, paths, left: typing.Optional[str], right: str):
+        """
+        Make room for instance by respacing a window of the siblings from right onward, between
+        left and the first sibling after the window
+        The window is doubled until the labels fit, so only the neighbourhood of a crowded
+        gap is rewritten
+        Returns the moves, or None if the window would take in all of the following siblings,
+        which a shift rewrites just as well
+        """
+        # Without a stride, labels are packed, so a window would only fit where siblings were
+        # deleted, which isn't worth a query per doubling
+        if self.path_factory.stride == 1:
+            return None
+
+        following = paths.filter(
+            **{f'{self.path_field}__gte': parent + [right]}
+        ).order_by(self.path_field)
+
+        size = 1
+
+        while True:
+            rows = list(following[:size + 1])
+
+            if len(rows) <= size:
+                return None
+
+            *window, boundary = rows
+
+            labels = self.path_factory.spread(left, boundary[-1], size + 1)
+
+            if labels is not None:
+                break
+
+            size *= 2
+
+        label, *labels = labels
+
+        setattr(instance, self.path_field, parent + [label])
+
+        return [
+            (path, parent + [label]) for path, label in zip(window, labels) if path[-1] != label
+        ]
+
+    def _resolve_siblings(self, instance, parent: Path, bound: typing.Optional[str]):
+        """
+        Assign a path to instance by loading all of its siblings
+        """
+        # So we can find the instance again later
+        instance_id = instance.id
 
         # If the instance is already saved and a sibling here
         # (so if you're trying to move an existing node to a different position)
-        # We need to add a temporary placeholder so that the insertion
-        # Point doesn't move on us
-        for i, child in enumerate(queryset):
-            if child.id == instance_id:
-                current_pos = i
-            else:
-                children.append(child)
+        # leave it out, so it doesn't count as its own neighbour
+        children = self._sibling_snapshot(
+            [tuple(parent)], exclude=Q(id=instance_id) if instance_id is not None else None
+        )[tuple(parent)]
 
         # Insert object to actually be created
-        # at desired index
-        # None is last index
-        if child_index is None:
-            children.append(instance)
-        else:
-            # Correct ????
-            if current_pos is not None and child_index > current_pos:
-                child_index -= 1
-
-            children.insert(child_index, instance)
+        self._insert_at_bound(children, instance, bound)
 
         # Sort again if ordering is desired
         if self._sort_key:
             children.sort(key=self._sort_key)
-            # self._sort_func(children)
 
+        # Before it's replaced by the new path
+        current_path = getattr(instance, self.path_field) if instance_id is not None else None
+
+        moves = self._allocate(parent, children, [instance])
+
+        return self._collapse_shift(parent, [child for child in children if child is not instance], current_path, moves)
+
+    def _collapse_shift(self, parent: Path, siblings, current_path: typing.Optional[Path], moves):
+        """
+        Replace the moves of relabeled siblings with a single Shift, if they're all of
+        the siblings from some label onward, and they're all moved by the same distance,
+        which is usually the case when a node is put in front of them
+        current_path is the path of the node being moved, if any, before the move
+        """
+        # Variable-length labels can't be incremented in the database
+        if len(moves) < 2 or isinstance(self.path_factory, FractionalPathFactory):
+            return moves
+
+        decode = self.path_factory.decode
+
+        start = min(old_path[-1] for old_path, new_path in moves)
+        delta = decode(moves[0][1][-1]) - decode(moves[0][0][-1])
+
+        if any(decode(new_path[-1]) - decode(old_path[-1]) != delta for old_path, new_path in moves):
+            return moves
+
+        # Siblings after the first moved one that stay put would be shifted as well
+        if sum(getattr(sibling, self.path_field)[-1] >= start for sibling in siblings) != len(moves):
+            return moves
+
+        # The node being moved mustn't be shifted, or be shifted onto, before it's moved,
+        # which it could be from under any of the siblings
+        depth = len(parent)
+
+        if current_path and current_path[:depth] == parent and (
+            decode(current_path[depth]) >= decode(start) + min(delta, 0)
+        ):
+            return moves
+
+        return [
+            Shift(parent, start, delta)
+        ]
+
+    def _fits(self, path: Path, parent: Path, left: typing.Optional[str], right: typing.Optional[str]) -> bool:
+        # Whether a node's current path is already a child of parent between the labels left and right
+        return (
+            path[:-1] == parent
+            and (left is None or left < path[-1])
+            and (right is None or path[-1] < right)
+        )
+
+    def _labels_between(self, parent: Path, children, new: typing.Set[int]):
+        """
+        Labels for the new children (by id()) between their existing neighbours
+        Saved nodes which are already between their neighbours keep their labels
+        Where a gap is exhausted, the new children are respaced along with a window of the
+        siblings after them, doubled until the labels fit
+        Returns a list of (child, label) pairs, including any respaced siblings, or None if
+        a window would take in all of the following siblings
+        """
+        labels = []
+        left = None
+        start = 0
+
+        def label(i):
+            return getattr(children[i], self.path_field)[-1] if i < len(children) else None
+
+        def skip_new(i):
+            # Index of the first existing child from i on
+            while i < len(children) and id(children[i]) in new:
+                i += 1
+
+            return i
+
+        while start < len(children):
+            if id(children[start]) not in new:
+                left = label(start)
+                start += 1
+                continue
+
+            stop = skip_new(start)
+            run = self._label_run(parent, children[start:stop], left, label(stop))
+            size = 1
+
+            while run is None:
+                end = skip_new(stop + size)
+
+                if end >= len(children):
+                    return None
+
+                run = self.path_factory.spread(left, label(end), end - start)
+
+                if run is not None:
+                    stop = end
+
+                size *= 2
+
+            labels.extend(zip(children[start:stop], run))
+
+            left = run[-1]
+            start = stop
+
+        return labels
+
+    def _label_run(self, parent: Path, run, left: typing.Optional[str], right: typing.Optional[str]):
+        # Labels for a run of new children between the labels left and right, or None
+        labels = []
+
+        for instance in run:
+            path = getattr(instance, self.path_field) if instance.pk is not None else None
+
+            if path and self._fits(path, parent, left, right):
+                left = path[-1]
+            else:
+                left = self.path_factory.between(left, right)
+
+            if left is None:
+                return None
+
+            labels.append(left)
+
+        return labels
+
+    def _allocate(self, parent: Path, children, instances):
+        """
+        Assign paths to instances, which have been placed in the ordered
+        list of their (new) siblings
+        Returns typing.List[typing.Tuple[Path, Path]]
+        a list of (old_path, new_path) tuples that must first be
+        moved
+        """
+        # Find by identity, unsaved model instances don't compare equal
+        new = {id(instance) for instance in instances}
+
+        # Common case, there's room between the neighbours of each run of new nodes,
+        # or in a window of siblings around them
+        # The new nodes get paths, the siblings are moved
+        labels = self._labels_between(parent, children, new)
+
+        if labels is not None:
+            moves = []
+
+            for child, label in labels:
+                correct_path = parent + [label]
+
+                if id(child) in new:
+                    setattr(child, self.path_field, correct_path)
+                elif getattr(child, self.path_field) != correct_path:
+                    moves.append(
+                        (getattr(child, self.path_field), correct_path)
+                    )
+
+            return moves
+
+        # No window fits, so relabel all of the siblings
         # Move tuples
         # (old_path, new_path)
         moves = []
@@ -251,7 +928,7 @@ class TreeManager(models.Manager):
         for i, child in enumerate(children):
             correct_path = self.path_factory.nth_child(parent, i)
 
-            if child.id == instance_id:
+            if id(child) in new:
                 # Mutate passed instance
                 setattr(child, self.path_field, correct_path)
                 continue
@@ -267,48 +944,550 @@ class TreeManager(models.Manager):
         # Return any children which must be moved
         return moves
 
-    def bulk_create(self, branch, **kwargs):
+    def bulk_create(self, branch, chunk_size: typing.Optional[int] = None, **kwargs):
         # Just does one branch
-        # I was going to have a bulkier api where you could create multiple branches at the same
-        # time, but it tended to make things more complicated because the entire tree mutates every
-        # time you graft a branch
+        # See bulk_create_branches for grafting several branches at the same time
+        # Anything that isn't a position, like batch_size, goes to QuerySet.bulk_create
+
+        using = self._db or router.db_for_write(self.model, **self._hints)
+
+        if chunk_size is None:
+            root = self._init_tree(branch)
+
+            # Position kwargs are popped off, the rest go to bulk_create
+            parent, bound = self._resolve(kwargs)
+
+            def write():
+                # Nodes from a failed attempt still have primary keys
+                if root.pk is not None:
+                    self._reset_tree(root)
+
+                with transaction.atomic(using=using, savepoint=False):
+                    moves = self._resolve_at(root, parent, bound)
+
+                    self._bulk_move(moves)
 
-        root = self._init_tree(branch)
+                    self._insert_branches([root], **kwargs)
+
+            self._retrying(write)
+
+            return root
+
+        # With a chunk_size, descendants are instantiated and inserted one chunk at a time,
+        # instead of building the whole tree up front
+        # They aren't kept, so the returned root isn't annotated with children
+        # The branch is consumed as it's inserted, so this isn't retried either
+        children = branch.pop('children', [])
+
+        root = self.model(
+            path=None,
+            **branch
+        )
+
+        def instantiate(path, node):
+            node.pop('children', None)
+
+            return self.model(
+                path=path,
+                **node
+            )
 
         # kwargs is mutated
-        moves = self._resolve_position(root, kwargs)
+        parent, bound = self._resolve(kwargs)
+
+        with transaction.atomic(using=using):
+            moves = self._resolve_at(root, parent, bound)
+
+            self._bulk_move(moves)
+
+            nodes = it.chain([root], it.starmap(
+                instantiate,
+                self._iter_tree(zip(self.path_factory.dotted_children(root.path, len(children)), children))
+            ))
 
-        self._bulk_move(moves)
+            while True:
+                chunk = list(it.islice(nodes, chunk_size))
 
-        # Recursively update the path attribute of all descendants and yield out flattened
-        # nodes
-        def flatten(node):
-            yield node
-            for i, child in enumerate(node.children):
-                child.path = self.path_factory.nth_child(node.path, i)
-                yield from flatten(child)
+                if not chunk:
+                    break
+
+                super().bulk_create(chunk, **kwargs)
+
+        return root
+
+    def _reset_tree(self, root):
+        # Make the nodes of a tree insertable again
+        stack = [root]
+
+        while stack:
+            node = stack.pop()
+            node.pk = None
+            node._state.adding = True
+            stack.extend(node.children)
+
+    def _insert_branches(self, roots, **kwargs):
+        """
+        Insert roots, which already have paths, along with all of their descendants
+        in one bulk_create
+        """
+        # Update the path attribute of all descendants and flatten them out, depth-first
+        # Descendants get dotted string paths, generated a whole family at a time, which
+        # the field passes straight through to the database
+        nodes = []
+        stack = list(reversed(roots))
+
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+
+            if node.children:
+                paths = self.path_factory.dotted_children(node.path, len(node.children))
+
+                for child, path in zip(node.children, paths):
+                    child.path = path
+
+                stack.extend(reversed(node.children))
 
         super().bulk_create(
-            flatten(root), **kwargs
+            nodes, **kwargs
         )
 
-        return root
+        # Hand back list paths, like everywhere else
+        for node in nodes:
+            if isinstance(node.path, str):
+                node.path = node.path.split('.')
+
+    def bulk_create_branches(self, branches, **kwargs):
+        """
+        Create several branches at once
+        branches is an iterable of (branch, position_kwargs) pairs, e.g.
+        [({'name': 'One', 'children': [...]}, {'child_of': node}), ...]
+        Positions must be relative to existing nodes, not to other new branches
+        Branches with the same position keep their order
+        Returns the list of new roots
+        """
+        resolved = []
+
+        for branch, position_kwargs in branches:
+            position_kwargs = dict(position_kwargs)
+
+            parent, bound = self.Position.resolve(
+                position_kwargs, path_field=self.path_field, path_factory=self.path_factory
+            )
+
+            if position_kwargs:
+                raise TypeError(f"Unexpected position kwargs: {position_kwargs!r}")
+
+            resolved.append((self._init_tree(branch), parent, bound))
+
+        roots = [root for root, parent, bound in resolved]
+
+        if not roots:
+            return roots
+
+        parents = {tuple(parent) for root, parent, bound in resolved}
+        placed = {id(root) for root in roots}
+
+        def write():
+            # Start over from unplaced, unsaved branches when retrying
+            # New branches are told apart from existing siblings by not having paths yet
+            for root in roots:
+                if root.pk is not None:
+                    self._reset_tree(root)
+
+                setattr(root, self.path_field, None)
+
+            with transaction.atomic(using=self._db or router.db_for_write(self.model, **self._hints), savepoint=False):
+                self._lock_parents(parents)
+
+                # Load the siblings of every parent that's being grafted onto in one query,
+                # and resolve every branch against that snapshot
+                siblings = self._sibling_snapshot(parents)
+
+                # After any new branches that were put there already
+                for root, parent, bound in resolved:
+                    self._insert_at_bound(siblings[tuple(parent)], root, bound, placed)
+
+                # Allocate deepest parents first, so the paths of new nodes under a parent that is
+                # itself relabeled can be carried along with it
+                moves = []
+
+                for parent in sorted(parents, key=len, reverse=True):
+                    children = siblings[parent]
+
+                    if self._sort_key:
+                        children.sort(key=self._sort_key)
+
+                    parent_moves = self._allocate(list(parent), children, [
+                        root for root, root_parent, bound in resolved if tuple(root_parent) == parent
+                    ])
+
+                    # New branches grafted under a moved sibling (which have already been allocated)
+                    # move along with it
+                    for old_path, new_path in parent_moves:
+                        depth = len(old_path)
+
+                        for root, root_parent, bound in resolved:
+                            if root_parent[:depth] == old_path:
+                                root_path = getattr(root, self.path_field)
+                                setattr(root, self.path_field, new_path + root_path[depth:])
+
+                    moves.append(parent_moves)
+
+                # Moves of siblings under different parents can go in one statement,
+                # unless one parent is being relabeled under another
+                moved_parents = [
+                    old_path for parent_moves in moves for old_path, new_path in parent_moves
+                ]
+
+                if any(
+                    list(parent[:len(old_path)]) == old_path
+                    for parent in parents for old_path in moved_parents
+                ):
+                    for parent_moves in moves:
+                        self._bulk_move(parent_moves)
+                else:
+                    self._bulk_move([move for parent_moves in moves for move in parent_moves])
+
+                self._insert_branches(roots, **kwargs)
+
+        self._retrying(write)
+
+        return roots
+
+    def _iter_tree(self, nodes):
+        """
+        Walk nested dicts depth-first without building the tree or recursing,
+        yielding (dotted path, node) pairs
+        nodes is an iterable of (dotted path, node) pairs for the top level
+        """
+        # Iterators of (path, node) pairs, one for each level of the current node's ancestors
+        stack = [iter(nodes)]
+
+        while stack:
+            for path, node in stack[-1]:
+                # Before yielding, so the node can be consumed (e.g. popping its children)
+                children = node.get('children')
+
+                yield path, node
+
+                if children:
+                    stack.append(zip(self.path_factory.dotted_children(path, len(children)), children))
+                    break
+            else:
+                stack.pop()
+
+    def bulk_load(self, branches, chunk_size: int = 10000, analyze: bool = False, **position_kwargs) -> int:
+        """
+        Stream nested dicts (like bulk_create takes) into the database with COPY,
+        appending them to the position (root=True by default)
+        Nothing is instantiated, so field values are written as given, or the field's default,
+        and the branches are kept in the order given, even with an ordering
+        With analyze, the table is analyzed afterwards, so the planner doesn't treat a freshly
+        loaded table as (nearly) empty until autovacuum gets to it, e.g. before a sort()
+        Raises TypeError for values that can't be written with COPY, such as hstore and ranges
+        Returns the number of rows written
+        """
+        if not position_kwargs:
+            position_kwargs = {'root': True}
+
+        parent, bound = self.Position.resolve(
+            position_kwargs, path_field=self.path_field, path_factory=self.path_factory
+        )
+
+        if bound is not None:
+            raise ValueError("bulk_load can only append branches")
+
+        if position_kwargs:
+            raise TypeError(f"Unexpected kwargs: {position_kwargs!r}")
+
+        using = self._db or router.db_for_write(self.model, **self._hints)
+        connection = connections[using]
+        quote_name = connection.ops.quote_name
+
+        # The database fills in the primary key
+        path_field = self.model._meta.get_field(self.path_field)
+        fields = [
+            field for field in self.model._meta.concrete_fields
+            if field is not path_field and not getattr(field, 'db_returning', False)
+        ]
+
+        # Accept field names and attnames (e.g. both category and category_id)
+        names = {name for field in fields for name in (field.name, field.attname)}
+        names |= {'children', self.path_field}
+
+        sql = 'COPY {} ({}) FROM STDIN'.format(
+            quote_name(self.model._meta.db_table),
+            ', '.join(quote_name(field.column) for field in [path_field, *fields])
+        )
+
+        prefix = '.'.join(parent) + '.' if parent else ''
+
+        def roots(label):
+            for branch in branches:
+                label = self.path_factory.between(label, None)
+
+                if label is None:
+                    raise ValueError(f"No room left to append children to {parent!r}")
+
+                yield prefix + label, branch
+
+        def row(path, node):
+            unknown = node.keys() - names
+
+            if unknown:
+                raise TypeError(f"Unexpected fields for {self.model.__name__}: {sorted(unknown)!r}")
+
+            values = [path]
+
+            for field in fields:
+                if field.attname in node:
+                    value = node[field.attname]
+                elif field.name in node:
+                    value = node[field.name]
+
+                    if field.is_relation and isinstance(value, models.Model):
+                        value = value.pk
+                else:
+                    value = field.get_default()
+
+                values.append(_copy_text(field.get_db_prep_save(value, connection)))
+
+            return '\t'.join(values) + '\n'
+
+        count = 0
+
+        # One transaction, so the deferred unique constraint is checked once all of the
+        # rows have been written (and nothing is left behind on failure)
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            self._lock_parents([parent])
+
+            last = self._children(parent).using(using).order_by(
+                f'-{self.path_field}'
+            ).values_list(self.path_field, flat=True).first()
+
+            rows = self._iter_tree(roots(None if last is None else last[-1]))
+
+            while True:
+                chunk = [row(path, node) for path, node in it.islice(rows, chunk_size)]
+
+                if not chunk:
+                    break
+
+                cursor.copy_expert(sql, io.StringIO(''.join(chunk)))
+                count += len(chunk)
+
+            if analyze and count:
+                cursor.execute(f'ANALYZE {quote_name(self.model._meta.db_table)}')
+
+        return count
 
     def _bulk_move(self, path_tuples: typing.Iterable[typing.Tuple[Path, Path]]) -> int:
         # We should probably check that all of the old/new paths
         # Are the same depth
-        # If you pass multiple path tuples and it happens that one is a subpath
-        # of another, very bad things will happen
+        # If one old path is a subpath of another, every node follows the deepest
+        # move it's under
+        path_tuples = list(path_tuples)
+
+        # Shifts are applied first, so the paths in the tuples are relative
+        # to the shifted siblings
+        count = sum(
+            self._shift(move) for move in path_tuples if isinstance(move, Shift)
+        )
 
-        q: typing.List[Q] = []
-        cases: typing.List[When] = []
+        path_tuples, nested = self._prune_moves(
+            move for move in path_tuples if not isinstance(move, Shift)
+        )
 
-        # This would almost certainly be simplified by a VALUES() join
-        for old_path, new_path in path_tuples:
-            # Sometimes happens if there are holes left in a tree
-            if old_path == new_path:
+        if not path_tuples:
+            return count
+        elif self.copy_threshold is not None and len(path_tuples) >= self.copy_threshold:
+            return count + self._bulk_move_copy(path_tuples, nested=nested)
+        elif self.move_strategy == 'case':
+            return count + self._bulk_move_case(path_tuples)
+        else:
+            return count + self._bulk_move_values(path_tuples, nested=nested)
+
+    def _prune_moves(self, path_tuples: typing.Iterable[typing.Tuple[Path, Path]]
+                     ) -> typing.Tuple[typing.List[typing.Tuple[Path, Path]], bool]:
+        """
+        Drop the moves which don't change anything (sometimes happens if there are
+        holes left in a tree) and tell whether any move is nested in another one
+        A no-op under another move has to be kept, or its subtree would follow the outer move
+        """
+        pruned = []
+        nested = False
+        # Kept moves which are ancestors of the current one, in path order
+        # an ancestor sorts right before its descendants
+        stack: typing.List[Path] = []
+
+        for old_path, new_path in sorted(path_tuples, key=op.itemgetter(0)):
+            old_path = list(old_path)
+
+            while stack and old_path[:len(stack[-1])] != stack[-1]:
+                stack.pop()
+
+            if stack:
+                nested = True
+            elif old_path == list(new_path):
                 continue
 
+            stack.append(old_path)
+            pruned.append((old_path, new_path))
+
+        return pruned, nested
+
+    def _shift(self, shift: Shift) -> int:
+        connection = connections[self._db or router.db_for_write(self.model, **self._hints)]
+        quote_name = connection.ops.quote_name
+
+        table = quote_name(self.model._meta.db_table)
+        column = quote_name(self.model._meta.get_field(self.path_field).column)
+
+        depth = len(shift.parent)
+        label = f'subpath({column}, {depth}, 1)'
+
+        # Increment the label at the parent's depth in place, keeping the rest of the path
+        if self.sql_functions:
+            new_label = f'{function_name(self.sql_functions, "increment")}(ltree2text({label}), {int(shift.delta)})'
+        else:
+            new_label = encode_sql(
+                self.path_factory,
+                f'{decode_sql(self.path_factory, f"ltree2text({label})")} + {int(shift.delta)}'
+            )
+
+        params: typing.List[str] = []
+        prefix = ''
+        where = [f'nlevel({column}) > {depth}', f'{label} >= %s::ltree']
+
+        if depth:
+            prefix = '%s::ltree || '
+            params.append('.'.join(shift.parent))
+
+        params.append(shift.label)
+
+        if depth:
+            where.append(f'{column} <@ %s::ltree')
+            params.append('.'.join(shift.parent))
+
+        sql = f"""
+            UPDATE {table}
+            SET {column} = {prefix}text2ltree({new_label}) || CASE
+                WHEN nlevel({column}) > {depth + 1} THEN subpath({column}, {depth + 1})
+                ELSE ''::ltree
+            END
+            WHERE {' AND '.join(where)}
+        """
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def _dotted_paths(self,
+                      path_tuples: typing.Iterable[typing.Tuple[Path, Path]]
+                      ) -> typing.Tuple[typing.List[str], typing.List[str]]:
+        old_paths: typing.List[str] = []
+        new_paths: typing.List[str] = []
+
+        for old_path, new_path in path_tuples:
+            # Match ltree normal formatting instead of arrays
+            old_paths.append('.'.join(old_path))
+            new_paths.append('.'.join(new_path))
+
+        return old_paths, new_paths
+
+    def _bulk_move_sql(self, connection, moves: str, nested: bool = False) -> str:
+        # UPDATE statement joining against the relation "moves" with
+        # columns (old_path, new_path)
+        quote_name = connection.ops.quote_name
+
+        table = quote_name(self.model._meta.db_table)
+        column = quote_name(self.model._meta.get_field(self.path_field).column)
+
+        if nested:
+            # A node under several moves would be updated by an arbitrary one of them,
+            # so pick the deepest for every node first
+            source = f"""(
+                SELECT DISTINCT ON (nodes.{column}) nodes.{column}, moves.old_path, moves.new_path
+                FROM {table} AS nodes
+                JOIN {moves} ON nodes.{column} <@ moves.old_path
+                ORDER BY nodes.{column}, nlevel(moves.old_path) DESC
+            ) AS moves"""
+            where = f'{table}.{column} = moves.{column}'
+        else:
+            source = moves
+            where = f'{table}.{column} <@ moves.old_path'
+
+        # subpath() raises for an offset equal to the depth, so the moved node itself
+        # needs its own branch
+        return f"""
+            UPDATE {table}
+            SET {column} = CASE
+                WHEN {table}.{column} = moves.old_path THEN moves.new_path
+                ELSE moves.new_path || subpath({table}.{column}, nlevel(moves.old_path))
+            END
+            FROM {source}
+            WHERE {where}
+        """
+
+    def _bulk_move_values(self, path_tuples: typing.Iterable[typing.Tuple[Path, Path]],
+                          nested: bool = False) -> int:
+        old_paths, new_paths = self._dotted_paths(path_tuples)
+
+        if not old_paths:
+            return 0
+
+        connection = connections[self._db or router.db_for_write(self.model, **self._hints)]
+
+        # The pairs are unnested into a relation and joined on, so the size of the
+        # statement doesn't grow with the number of pairs
+        sql = self._bulk_move_sql(
+            connection, 'unnest(%s::ltree[], %s::ltree[]) AS moves (old_path, new_path)', nested
+        )
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [old_paths, new_paths])
+            return cursor.rowcount
+
+    def _bulk_move_copy(self, path_tuples: typing.Iterable[typing.Tuple[Path, Path]],
+                        nested: bool = False) -> int:
+        old_paths, new_paths = self._dotted_paths(path_tuples)
+
+        if not old_paths:
+            return 0
+
+        using = self._db or router.db_for_write(self.model, **self._hints)
+        connection = connections[using]
+
+        staging = connection.ops.quote_name(f'{self.model._meta.db_table}_moves')
+
+        # Labels can't contain tabs, newlines or backslashes, so no escaping is necessary
+        rows = io.StringIO(''.join(
+            f'{old_path}\t{new_path}\n' for old_path, new_path in zip(old_paths, new_paths)
+        ))
+
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE {staging} (old_path ltree NOT NULL, new_path ltree NOT NULL) ON COMMIT DROP'
+            )
+            cursor.copy_expert(f'COPY {staging} (old_path, new_path) FROM STDIN', rows)
+            # Give the planner row estimates for the join
+            cursor.execute(f'ANALYZE {staging}')
+
+            cursor.execute(self._bulk_move_sql(connection, f'{staging} AS moves', nested))
+            count = cursor.rowcount
+
+            # Might still be inside an outer transaction, and we may get called again
+            cursor.execute(f'DROP TABLE {staging}')
+
+        return count
+
+    def _bulk_move_case(self, path_tuples: typing.Iterable[typing.Tuple[Path, Path]]) -> int:
+        q: typing.List[Q] = []
+        cases: typing.List[When] = []
+
+        # The first matching arm wins, so deepest first for nested moves
+        for old_path, new_path in sorted(path_tuples, key=lambda move: len(move[0]), reverse=True):
             # Match ltree normal formatting instead of arrays
             new_path = '.'.join(new_path)
 
@@ -351,20 +1530,163 @@ class TreeManager(models.Manager):
 
         assert current_path
 
-        moves = self._resolve_position(instance, position_kwargs)
-
-        new_depth = len(instance.path)
+        # Validated before the transaction, where raising would spoil the caller's transaction
+        parent, bound = self._resolve(dict(position_kwargs))
 
-        if new_depth > current_depth and instance.path[:current_depth] == current_path:
+        if parent[:current_depth] == current_path:
             raise ValueError("Cannot move a node to be its own descendant.")
 
-        moves.append(
-            (current_path, instance.path)
-        )
+        def write():
+            # Start over from the current position when retrying
+            instance.path = list(current_path)
+
+            # Holds any locks until the move is done
+            # No savepoint, an error aborts the transaction anyway
+            with transaction.atomic(using=self._db or router.db_for_write(self.model, **self._hints), savepoint=False):
+                moves = self._resolve_at(instance, parent, bound)
+
+                # Already in place, nothing to write
+                if not moves and instance.path == current_path:
+                    return
+
+                moves.append(
+                    (current_path, instance.path)
+                )
+
+                # assert False, moves
+
+                self._bulk_move(moves)
+
+        self._retrying(write)
+
+    def move_many(self, moves):
+        """
+        Move several nodes at once
+        moves is an iterable of (node, position_kwargs) pairs, e.g.
+        [(node, {'child_of': other}), ...]
+        Positions are resolved against the tree as it was before any of the moves, so a node
+        can be moved under another node which is moved as well, and a descendant of a moved
+        node can be moved somewhere else on its own
+        Nodes with the same position keep their order
+        """
+        resolved = []
+        seen = set()
+
+        for instance, position_kwargs in moves:
+            position_kwargs = dict(position_kwargs)
+
+            parent, bound = self.Position.resolve(
+                position_kwargs, path_field=self.path_field, path_factory=self.path_factory
+            )
+
+            if position_kwargs:
+                raise TypeError(f"Unexpected position kwargs: {position_kwargs!r}")
+
+            current_path = list(getattr(instance, self.path_field))
+
+            assert current_path
+
+            # Would have to pick one of the positions
+            if tuple(current_path) in seen:
+                raise ValueError(f"Cannot move a node more than once: {instance!r}")
+
+            if parent[:len(current_path)] == current_path:
+                raise ValueError("Cannot move a node to be its own descendant.")
+
+            seen.add(tuple(current_path))
+            resolved.append((instance, current_path, parent, bound))
+
+        if not resolved:
+            return
+
+        # A node can't end up under itself through other moves either, e.g. A under B and
+        # B under a child of A
+        # Follow each new parent to the deepest move it's under, and that move's new parent, and so on
+        moved = {tuple(current_path): parent for instance, current_path, parent, bound in resolved}
+
+        for instance, current_path, parent, bound in resolved:
+            ancestors = {tuple(current_path)}
+            path = parent
+
+            while True:
+                under = next((
+                    tuple(path[:depth]) for depth in range(len(path), 0, -1) if tuple(path[:depth]) in moved
+                ), None)
 
-        # assert False, moves
+                if under is None:
+                    break
 
-        self._bulk_move(moves)
+                if under in ancestors:
+                    raise ValueError("Cannot move a node to be its own descendant.")
+
+                ancestors.add(under)
+                path = moved[under]
+
+        parents = {tuple(parent) for instance, current_path, parent, bound in resolved}
+        moving = {id(instance) for instance, current_path, parent, bound in resolved}
+
+        def write():
+            # Start over from the current positions when retrying
+            for instance, current_path, parent, bound in resolved:
+                setattr(instance, self.path_field, list(current_path))
+
+            with transaction.atomic(using=self._db or router.db_for_write(self.model, **self._hints), savepoint=False):
+                # Including the parents the nodes are moved away from
+                self._lock_parents(parents | {
+                    tuple(current_path[:-1]) for instance, current_path, parent, bound in resolved
+                })
+
+                # Load the siblings of every parent that's being moved to in one query,
+                # without the nodes that are being moved
+                siblings = self._sibling_snapshot(parents, exclude=reduce(op.or_, (
+                    Q(**{self.path_field: current_path})
+                    for instance, current_path, parent, bound in resolved
+                )))
+
+                # After any moved nodes that were put there already
+                for instance, current_path, parent, bound in resolved:
+                    self._insert_at_bound(siblings[tuple(parent)], instance, bound, moving)
+
+                # Every move, including siblings that have to be relabeled, as
+                # old path -> new path, both relative to the tree before any moves
+                targets: typing.Dict[typing.Tuple[str, ...], Path] = {}
+
+                for parent, children in siblings.items():
+                    if self._sort_key:
+                        children.sort(key=self._sort_key)
+
+                    for old_path, new_path in self._allocate(list(parent), children, [
+                        child for child in children if id(child) in moving
+                    ]):
+                        targets[tuple(old_path)] = new_path
+
+                for instance, current_path, parent, bound in resolved:
+                    targets[tuple(current_path)] = getattr(instance, self.path_field)
+
+                def translate(path):
+                    # Where a path ends up, following the deepest move it's under,
+                    # whose new parent might be under another move itself
+                    # Cycles were ruled out up front, so this ends
+                    for depth in range(len(path), 0, -1):
+                        old_path = tuple(path[:depth])
+
+                        if old_path not in targets:
+                            continue
+
+                        new_path = targets[old_path]
+
+                        return translate(new_path[:-1]) + new_path[-1:] + path[depth:]
+
+                    return list(path)
+
+                path_tuples = [(list(old_path), translate(list(old_path))) for old_path in targets]
+
+                for instance, current_path, parent, bound in resolved:
+                    setattr(instance, self.path_field, translate(current_path))
+
+                self._bulk_move(path_tuples)
+
+        self._retrying(write)
 
 
     def create(self, **kwargs):
@@ -377,24 +1699,70 @@ class TreeManager(models.Manager):
             except KeyError:
                 continue
 
-        obj = self.model(
-            path=None,
-            **kwargs
-        )
-
         self._for_write = True
 
-        moves = self._resolve_position(obj, position_kwargs)
+        # Validated before the transaction, where raising would spoil the caller's transaction
+        parent, bound = self._resolve(position_kwargs)
 
-        self._bulk_move(moves)
+        def write():
+            obj = self.model(
+                path=None,
+                **kwargs
+            )
+
+            # Holds any locks until the node is saved
+            with transaction.atomic(using=self.db, savepoint=False):
+                moves = self._resolve_at(obj, parent, bound)
+
+                self._bulk_move(moves)
+
+                obj.save(force_insert=True, using=self.db)
 
-        obj.save(force_insert=True, using=self.db)
+            return obj
 
-        return obj
+        return self._retrying(write)
 
-    # Recursively sort all children with the supplied key func
+    # Recursively sort all children with the supplied key func, or by fields
     # Will also remove any gaps left from deletion/moving of old nodes
-    def sort(self, key):
+    # With within, only the descendants of that node are sorted
+    def sort(self, key, within=None):
+        # A field name, or a sequence of them, is sorted by the database
+        # Anything else is a key function for sorting in Python
+        if isinstance(key, str):
+            key = (key,)
+
+        if callable(key):
+            return self._relabel_python(key, within)
+
+        return self._relabel(tuple(key), within)
+
+    def compact(self, within=None):
+        """
+        Renumber all labels (or only those of the descendants of within) from the start,
+        closing any gaps left from deletion/moving of old nodes, keeping the current order
+        """
+        return self._relabel((), within)
+
+    def _within_path(self, within) -> Path:
+        # Duck-type model instances
+        if hasattr(within, self.path_field):
+            within = getattr(within, self.path_field)
+
+        if within is None:
+            return []
+        elif isinstance(within, str):
+            return within.split('.')
+
+        return list(within)
+
+    def _relabel(self, fields: typing.Tuple[str, ...], within) -> int:
+        # Labels can't be generated in SQL
+        if isinstance(self.path_factory, FractionalPathFactory):
+            return self._relabel_python(op.attrgetter(*fields, self.path_field), within)
+
+        return self._relabel_sql(fields, within)
+
+    def _relabel_python(self, key, within) -> int:
         def flatten(nodes, path):
             nodes = sorted(nodes, key=key)
 
@@ -407,11 +1775,190 @@ class TreeManager(models.Manager):
 
                 yield from flatten(node.children, new_path)
 
-        # Return value ???
-        return self.bulk_update(
-            flatten(
-                self.all().roots(),
-                []
-            ),
-            fields=['path']
-        )
+        within = self._within_path(within)
+
+        # The key can raise anything, so keep the savepoint, and the caller's transaction usable
+        with transaction.atomic(using=self._db or router.db_for_write(self.model, **self._hints)):
+            # Everything under within is being written
+            self._lock_parents([within])
+
+            if within:
+                # The only root is within itself, which keeps its path
+                roots = [
+                    child
+                    for root in self.filter(**{f'{self.path_field}__descendant_of': within}).roots()
+                    for child in root.children
+                ]
+            else:
+                roots = self.all().roots()
+
+            # Return value ???
+            return self.bulk_update(
+                flatten(
+                    roots,
+                    within
+                ),
+                fields=['path']
+            )
+
+    def _relabel_sql(self, fields: typing.Tuple[str, ...], within, levels: typing.Optional[int] = None) -> int:
+        """
+        Sort all children by fields (or keep their order, without any), as compared by the database,
+        computing their new labels with row_number() instead of loading the tree
+        Levels are relabeled from the top down, one UPDATE each, carrying subtrees along
+        With levels, only that many levels below within are relabeled
+        Ties keep their current order
+        """
+        using = self._db or router.db_for_write(self.model, **self._hints)
+        connection = connections[using]
+        quote_name = connection.ops.quote_name
+
+        table = quote_name(self.model._meta.db_table)
+        column = quote_name(self.model._meta.get_field(self.path_field).column)
+
+        within = self._within_path(within)
+
+        # Everything is relabeled below this level
+        top = len(within)
+
+        order_by = ', '.join([
+            *(f'nodes.{quote_name(self.model._meta.get_field(field).column)}' for field in fields),
+            f'nodes.{column}'
+        ])
+
+        parent = f'subpath(nodes.{column}, 0, nlevel(nodes.{column}) - 1)'
+
+        row_number = f'(row_number() OVER (PARTITION BY {parent} ORDER BY {order_by}) - 1)'
+
+        if self.sql_functions:
+            new_path = f'{function_name(self.sql_functions, "nth_child")}({parent}, {row_number})'
+        else:
+            label = encode_sql(
+                self.path_factory,
+                f'{row_number} * {int(self.path_factory.stride)} + {int(self.path_factory.offset)}'
+            )
+            new_path = f'{parent} || text2ltree({label})'
+
+        # Only touch the subtree, which the GiST index can find
+        params = {'within': '.'.join(within)}
+        scope = 'TRUE'
+        nodes_scope = 'TRUE'
+
+        if within:
+            scope = f'{table}.{column} <@ %(within)s::ltree'
+            nodes_scope = f'nodes.{column} <@ %(within)s::ltree AND nlevel(nodes.{column}) > {top}'
+
+        if levels is not None:
+            nodes_scope += f' AND nlevel(nodes.{column}) <= {top + int(levels)}'
+
+        count = 0
+
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            # Everything under within is being written
+            self._lock_parents([within])
+
+            cursor.execute(f"""
+                SELECT max(nlevel(parent)) + 1, max(siblings)
+                FROM (
+                    SELECT {parent} AS parent, count(*) AS siblings
+                    FROM {table} AS nodes
+                    WHERE {nodes_scope}
+                    GROUP BY 1
+                ) AS families
+            """, params)
+
+            depth, siblings = cursor.fetchone()
+
+            if depth is None:
+                return 0
+
+            # Labels would silently wrap around in SQL, so make sure the biggest family fits
+            self.path_factory.nth_child([], siblings - 1)
+
+            for level in range(top + 1, depth + 1):
+                # Nodes are matched to their moved ancestor at this level by equality,
+                # which (unlike <@) can be hashed or merged
+                cursor.execute(f"""
+                    UPDATE {table}
+                    SET {column} = CASE
+                        WHEN nlevel({table}.{column}) = {level} THEN moves.new_path
+                        ELSE moves.new_path || subpath({table}.{column}, {level})
+                    END
+                    FROM (
+                        SELECT old_path, new_path
+                        FROM (
+                            SELECT nodes.{column} AS old_path, {new_path} AS new_path
+                            FROM {table} AS nodes
+                            WHERE {nodes_scope} AND nlevel(nodes.{column}) = {level}
+                        ) AS labels
+                        WHERE old_path <> new_path
+                    ) AS moves
+                    WHERE {scope}
+                    AND nlevel({table}.{column}) >= {level}
+                    AND subpath({table}.{column}, 0, {level}) = moves.old_path
+                """, params)
+
+                count += cursor.rowcount
+
+        return count
+
+    def _compact_family(self, parent: Path) -> int:
+        # Renumber the children of parent, carrying their subtrees along
+        if not isinstance(self.path_factory, FractionalPathFactory):
+            return self._relabel_sql((), parent, levels=1)
+
+        # Labels can't be generated in SQL
+        self._lock_parents([parent])
+
+        moves = [
+            (path, self.path_factory.nth_child(parent, i))
+            for i, path in enumerate(self._children(parent).order_by(self.path_field).values_list(
+                self.path_field, flat=True
+            ))
+        ]
+
+        return self._bulk_move(moves)
+
+    def compact_batches(self, batch_size: int = 100, cursor: typing.Optional[str] = None):
+        """
+        Compact the whole tree a family at a time, batch_size parents per transaction,
+        so it can run against a live table without holding locks for long
+        Yields a cursor (the dotted path of the last compacted parent) after each batch is committed
+        Pass it back in as cursor to resume from there
+        """
+        using = self._db or router.db_for_write(self.model, **self._hints)
+
+        # Compacting a parent only relabels its descendants, which all sort after it,
+        # so parents are visited in path order
+        # An empty cursor means the roots have been done
+        while True:
+            compacted = 0
+
+            with transaction.atomic(using=using):
+                while compacted < batch_size:
+                    parent = [] if cursor is None else self._next_parent(cursor)
+
+                    if parent is None:
+                        break
+
+                    self._compact_family(parent)
+                    cursor = '.'.join(parent)
+                    compacted += 1
+
+            if compacted:
+                yield cursor
+
+            if compacted < batch_size:
+                return
+
+    def _next_parent(self, cursor: str) -> typing.Optional[Path]:
+        # The first node after cursor, whose parent is also after cursor, is
+        # the first child of the next parent (in path order)
+        # Walks the path index from cursor
+        return self.filter(
+            **{f'{self.path_field}__gt': cursor}
+        ).annotate(
+            parent_path=Subpath(self.path_field, 0, -1)
+        ).filter(
+            parent_path__gt=cursor
+        ).order_by(self.path_field).values_list('parent_path', flat=True).first()
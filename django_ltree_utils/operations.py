@@ -0,0 +1,186 @@
+import typing
+
+from django.db import router
+from django.db.migrations.operations.base import Operation
+
+from .paths import ALPHANUMERIC_SENSITIVE, PathFactory
+from .sql import decode_sql, encode_sql, function_name
+
+
+def _allowed(app_label, schema_editor) -> bool:
+    # Whether an operation should touch this database, like the ones in django.contrib.postgres
+    connection = schema_editor.connection
+    return connection.vendor == 'postgresql' and router.allow_migrate(connection.alias, app_label)
+
+
+class CreateLabelFunctions(Operation):
+    """
+    Install SQL functions mirroring a PathFactory with the given alphabet, max_length and stride,
+    so labels can be computed in the database, and statements can call them instead of inlining
+    the equivalent expressions
+    The functions are named after prefix:
+
+        ltree_utils_encode(value bigint) -> text
+        ltree_utils_decode(label text) -> bigint
+        ltree_utils_increment(label text, delta bigint) -> text
+        ltree_utils_nth_child(path ltree, n bigint) -> ltree
+
+    Values which are too large wrap around instead of raising, like sql.encode_sql()
+    Pass the same prefix to the TreeManager as sql_functions to use them
+
+    Add it to a migration of your app:
+
+        operations = [
+            CreateLabelFunctions(),
+            ...
+        ]
+    """
+    reversible = True
+
+    def __init__(self,
+                 prefix: str = 'ltree_utils',
+                 alphabet: str = ALPHANUMERIC_SENSITIVE,
+                 max_length: int = 4,
+                 stride: int = 1):
+        # Raises for anything that can't be used as a name
+        function_name(prefix, '')
+
+        self.prefix = prefix
+        self.alphabet = alphabet
+        self.max_length = max_length
+        self.stride = stride
+
+    def functions(self) -> typing.List[typing.Tuple[str, str, str, str]]:
+        # (name, arguments, return type, body)
+        path_factory = PathFactory(alphabet=self.alphabet, max_length=self.max_length, stride=self.stride)
+
+        encode = function_name(self.prefix, 'encode')
+        decode = function_name(self.prefix, 'decode')
+
+        # Calls to the other functions are inlined as well
+        return [
+            (encode, 'value bigint', 'text', f'SELECT {encode_sql(path_factory, "value")}'),
+            (decode, 'label text', 'bigint', f'SELECT {decode_sql(path_factory, "label")}'),
+            # The label delta (not strides) after label
+            (
+                function_name(self.prefix, 'increment'),
+                'label text, delta bigint',
+                'text',
+                f'SELECT {encode}({decode}(label) + delta)'
+            ),
+            (
+                function_name(self.prefix, 'nth_child'),
+                'path ltree, n bigint',
+                'ltree',
+                f'SELECT path || text2ltree({encode}(n * {path_factory.stride} + {path_factory.offset}))'
+            ),
+        ]
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if not _allowed(app_label, schema_editor):
+            return
+
+        # Plain SQL functions which are immutable can be inlined into the calling statement
+        for name, arguments, returns, body in self.functions():
+            schema_editor.execute(
+                f'CREATE OR REPLACE FUNCTION {name}({arguments}) RETURNS {returns} AS $$ {body} $$ '
+                f'LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE'
+            )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if not _allowed(app_label, schema_editor):
+            return
+
+        for name, arguments, returns, body in self.functions():
+            # Dropping needs the argument types, without the names
+            types = ', '.join(argument.split()[-1] for argument in arguments.split(', '))
+
+            schema_editor.execute(f'DROP FUNCTION IF EXISTS {name}({types})')
+
+    def describe(self):
+        return f"Creates label functions {self.prefix}_*"
+
+
+class CreateDeleteDescendantsTrigger(Operation):
+    """
+    Install a trigger which deletes the descendants of deleted nodes of a model, however they're
+    deleted, so no orphans are left behind
+    The trigger runs once per statement, with all of the deleted rows in a transition table, so
+    the descendants of a whole delete() are removed with one more DELETE
+    Descendants are deleted by the database, so Django doesn't send signals for them or collect
+    their related objects, see TreeQuerySet.delete_subtrees(signals=True) for that
+
+    Add it to a migration of your app, after the model is created:
+
+        operations = [
+            migrations.CreateModel(name='Category', ...),
+            CreateDeleteDescendantsTrigger('category'),
+        ]
+    """
+    reversible = True
+
+    def __init__(self, model_name: str, path_field: str = 'path'):
+        self.model_name = model_name
+        self.path_field = path_field
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def _names(self, app_label, schema_editor, state) -> typing.Tuple[str, str, str]:
+        # Quoted table, path column and trigger (and function) names
+        model = state.apps.get_model(app_label, self.model_name)
+
+        table = model._meta.db_table
+        column = model._meta.get_field(self.path_field).column
+
+        return (
+            schema_editor.quote_name(table),
+            schema_editor.quote_name(column),
+            schema_editor.quote_name(f'{table}_delete_descendants')
+        )
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if not _allowed(app_label, schema_editor):
+            return
+
+        table, column, name = self._names(app_label, schema_editor, to_state)
+
+        # The DELETE in the trigger fires it again, which deletes nothing more, so the one
+        # after that has no rows and stops
+        # (The trigger depth can't tell it apart from a delete issued by another trigger)
+        schema_editor.execute(f"""
+            CREATE OR REPLACE FUNCTION {name}() RETURNS trigger AS $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM deleted) THEN
+                    RETURN NULL;
+                END IF;
+
+                DELETE FROM {table} WHERE {column} <@ ANY(ARRAY(SELECT {column} FROM deleted));
+
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+
+        schema_editor.execute(f"""
+            CREATE TRIGGER {name}
+            AFTER DELETE ON {table}
+            REFERENCING OLD TABLE AS deleted
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE {name}()
+        """)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if not _allowed(app_label, schema_editor):
+            return
+
+        table, column, name = self._names(app_label, schema_editor, from_state)
+
+        schema_editor.execute(f'DROP TRIGGER IF EXISTS {name} ON {table}')
+        schema_editor.execute(f'DROP FUNCTION IF EXISTS {name}()')
+
+    def describe(self):
+        return f"Creates a trigger deleting the descendants of deleted {self.model_name} nodes"
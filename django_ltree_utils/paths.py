@@ -1,5 +1,4 @@
-import collections
-import itertools as it
+import functools
 import string
 import typing
 
@@ -15,20 +14,50 @@ Path = typing.List[str]
 # M preserves lexicographical order
 # this is much harder and not obvious how to approach
 # Probably a divide-and-conquer method
+# FractionalPathFactory sidesteps this by treating labels as fractions instead of integers
 
 
 ALPHANUMERIC_SENSITIVE = string.digits + string.ascii_uppercase + string.ascii_lowercase
 
 
+class Tables(typing.NamedTuple):
+    # Every two-digit chunk, in order
+    pairs: typing.List[str]
+    # Value of every two-digit chunk
+    reverse_pairs: typing.Dict[str, int]
+    # Encoded labels for every value below base ** 2, the most commonly used ones
+    labels: typing.List[str]
+
+
+@functools.lru_cache(maxsize=None)
+def _tables(alphabet: str, max_length: int) -> Tables:
+    # Shared by every factory with the same alphabet and length
+    pairs = [high + low for high in alphabet for low in alphabet]
+
+    if max_length >= 2:
+        labels = [alphabet[0] * (max_length - 2) + pair for pair in pairs]
+    else:
+        labels = list(alphabet[:len(alphabet) ** max_length])
+
+    return Tables(
+        pairs=pairs,
+        reverse_pairs={pair: i for i, pair in enumerate(pairs)},
+        labels=labels
+    )
+
+
 class PathFactory:
     """
     Responsible for manipulating and creating "path" lists.
     Each label is treated as a fixed-length, zero-padded base62-encoded integer.
     This ensures that we can create a new path to the left or right of an existing path while maintaining
     lexicographical order.
+
+    With a stride greater than one, sibling labels are allocated sparsely, leaving room to insert
+    new labels between existing neighbours without renumbering the rest of the siblings.
     """
 
-    def __init__(self, alphabet: str = ALPHANUMERIC_SENSITIVE, max_length: int = 4):
+    def __init__(self, alphabet: str = ALPHANUMERIC_SENSITIVE, max_length: int = 4, stride: int = 1):
         # Alphabet is in ASCII order
         self.alphabet = alphabet
         self.reverse = {
@@ -37,24 +66,36 @@ class PathFactory:
         self.base = len(self.alphabet)
         self.max_length = max_length
 
+        if stride < 1:
+            raise ValueError(f"Stride must be a positive integer, got {stride!r}")
+
+        # Distance between consecutively allocated labels
+        # A stride of 1 is the dense (original) allocation
+        self.stride = stride
+        # Offset the first label, so there is some room in front of it as well
+        self.offset = stride // 2
+
+        self._tables = _tables(alphabet, max_length)
+        self._square = self.base ** 2
+
     # encode/decode are the heart of this class
     def encode(self, value: int) -> str:
-        if value < 0:
-            raise ValueError
-
-        d: typing.Deque[str] = collections.deque()
+        labels = self._tables.labels
 
-        appendleft = d.appendleft
-        alphabet = self.alphabet
+        if value < 0:
+            raise ValueError(f"Cannot encode negative value: {value!r}")
+        elif value < len(labels):
+            return labels[value]
 
-        while value:
-            value, rem = divmod(value, self.base)
-            appendleft(alphabet[rem])
+        # Encode everything but the last two digits, then use the table for those
+        high, low = divmod(value, self._square)
 
-        if len(d) > self.max_length:
+        if self.max_length < 2 or high >= self.base ** (self.max_length - 2):
             raise ValueError(f"Cannot encode fixed-length base-{self.base}: {value!r}")
 
-        return ''.join(d).zfill(self.max_length)
+        prefix = labels[high] if high < len(labels) else PathFactory.encode(self, high)
+
+        return prefix[2:] + self._tables.pairs[low]
 
     def decode(self, chars: str) -> int:
         # An unnecessarily baroque implementation which fits on one line
@@ -69,32 +110,225 @@ class PathFactory:
         #     )
         # )
 
-        total = 0
-        radix = 1
+        reverse_pairs = self._tables.reverse_pairs
+        square = self._square
+
+        # Fast paths for the default length
+        if len(chars) == 4:
+            return reverse_pairs[chars[:2]] * square + reverse_pairs[chars[2:]]
+        elif len(chars) == 2:
+            return reverse_pairs[chars]
+
+        # Odd digit out at the front, then two digits at a time
+        start = len(chars) % 2
+        total = self.reverse[chars[0]] if start else 0
 
-        for digit in map(self.reverse.__getitem__, chars[::-1]):
-            total += digit * radix
-            radix *= self.base
+        for i in range(start, len(chars), 2):
+            total = total * square + reverse_pairs[chars[i:i + 2]]
 
         return total
 
+    def encode_range(self, start: int, stop: int, step: int = 1) -> typing.Iterator[str]:
+        """
+        Labels for range(start, stop, step)
+        Consecutive labels are produced by incrementing the last two digits and
+        only re-encoding the rest of the label on carry
+        """
+        values = range(start, stop, step)
+
+        if not values:
+            return
+
+        # Raise for out of range values up front
+        self.encode(values[0])
+        self.encode(values[-1])
+
+        if self.max_length < 2 or step < 1:
+            yield from map(self.encode, values)
+            return
+
+        pairs = self._tables.pairs
+        square = self._square
+
+        high, low = divmod(start, square)
+        # Fixed-length, even for subclasses that trim labels
+        prefix = PathFactory.encode(self, high * square)[:-2]
+
+        for _ in values:
+            if low >= square:
+                carry, low = divmod(low, square)
+                high += carry
+                prefix = PathFactory.encode(self, high * square)[:-2]
+
+            yield prefix + pairs[low]
+
+            low += step
+
     def split(self, path: Path) -> typing.Tuple[Path, int]:
         *parent, position = path
         return parent, self.decode(position)
 
     def nth_child(self, path: Path, n: int) -> Path:
-        return path + [self.encode(n)]
+        return path + [self.encode(n * self.stride + self.offset)]
 
     def children(self, path: Path) -> typing.Iterator[Path]:
-        for label in map(self.encode, it.count()):
+        for label in self.encode_range(self.offset, self.base ** self.max_length, self.stride):
             yield path + [label]
 
+    def dotted_children(self, path: typing.Union[Path, str], count: int) -> typing.List[str]:
+        """
+        The first count children of path, as dotted strings, which the ltree field accepts as-is
+        Same labels as nth_child(), but the parent's prefix is only joined once
+        path may already be a dotted string
+        """
+        prefix = path if isinstance(path, str) else '.'.join(path)
+
+        if prefix:
+            prefix += '.'
+
+        labels = self.encode_range(self.offset, self.offset + count * self.stride, self.stride)
+
+        return [prefix + label for label in labels]
+
     def next_siblings(self, path: Path) -> typing.Iterator[Path]:
         parent, child_index = self.split(path)
 
         # Tabulate
-        start_index = child_index + 1
-        labels = map(self.encode, it.count(start_index))
+        start_index = child_index + self.stride
+        labels = self.encode_range(start_index, self.base ** self.max_length, self.stride)
 
         for label in labels:
             yield parent + [label]
+
+    def between(self, left: typing.Optional[str], right: typing.Optional[str]) -> typing.Optional[str]:
+        """
+        Return a label which sorts strictly between the labels left and right.
+        None for either side means there is no neighbour on that side.
+        Returns None if the gap between the two labels is exhausted, in which case the
+        siblings must be relabeled.
+        """
+        low = -1 if left is None else self.decode(left)
+        high = self.base ** self.max_length if right is None else self.decode(right)
+
+        # Prefer keeping a full stride from the neighbour when appending or prepending,
+        # so repeated appends don't halve the remaining gap every time
+        if left is None and right is None:
+            value = self.offset
+        elif right is None:
+            value = low + self.stride
+        elif left is None:
+            value = high - self.stride
+        else:
+            value = (low + high) // 2
+
+        if not low < value < high:
+            value = (low + high) // 2
+
+        if not low < value < high:
+            return None
+
+        return self.encode(value)
+
+    def spread(self, left: typing.Optional[str], right: typing.Optional[str], count: int) -> typing.Optional[typing.List[str]]:
+        """
+        Return count labels, evenly spaced strictly between the labels left and right.
+        None for either side means there is no neighbour on that side.
+        Returns None if they would be packed tighter than half a stride (or than every other
+        label), in which case a wider range of siblings should be respaced instead.
+        """
+        low = -1 if left is None else self.decode(left)
+        high = self.base ** self.max_length if right is None else self.decode(right)
+
+        spacing = (high - low) // (count + 1)
+
+        if spacing < max(self.stride // 2, 2):
+            return None
+
+        return [self.encode(low + spacing * (i + 1)) for i in range(count)]
+
+
+class FractionalPathFactory(PathFactory):
+    """
+    Labels are variable-length, and treated as the digits of a base62 fraction between zero and one,
+    with any trailing zeros stripped. Ordering labels lexicographically is the same as ordering the
+    fractions, so a new label can always be created between any two existing labels, and siblings
+    never have to be shifted to make room.
+
+    Labels grow by about one character for every six inserts into the same gap (or in front of the
+    first sibling), so a busy gap should eventually be compacted by relabeling the siblings.
+    """
+
+    def __init__(self, alphabet: str = ALPHANUMERIC_SENSITIVE, max_length: int = 4, stride: int = 1):
+        super().__init__(alphabet=alphabet, max_length=max_length, stride=stride)
+        # Zero would be the empty label
+        self.offset = max(stride // 2, 1)
+
+    def encode(self, value: int) -> str:
+        return super().encode(value).rstrip(self.alphabet[0])
+
+    def decode(self, chars: str) -> int:
+        # Only meaningful for labels of up to max_length characters
+        return super().decode(chars.ljust(self.max_length, self.alphabet[0]))
+
+    def encode_range(self, start: int, stop: int, step: int = 1) -> typing.Iterator[str]:
+        zero = self.alphabet[0]
+
+        for label in super().encode_range(start, stop, step):
+            yield label.rstrip(zero)
+
+    def between(self, left: typing.Optional[str], right: typing.Optional[str]) -> typing.Optional[str]:
+        """
+        Return a label which sorts strictly between the labels left and right.
+        None for either side means there is no neighbour on that side.
+        Only returns None if the neighbours are out of order.
+        """
+        if left is not None and right is not None and left >= right:
+            return None
+
+        # When appending or prepending, step a full stride away from the neighbour
+        # instead of halving the remaining space every time
+        if left is None and right is None:
+            return self.encode(self.offset)
+        elif right is None and len(left) <= self.max_length:
+            value = self.decode(left) + self.stride
+
+            if value < self.base ** self.max_length:
+                return self.encode(value)
+        elif left is None and len(right) <= self.max_length:
+            value = self.decode(right) - self.stride
+
+            if value > 0:
+                return self.encode(value)
+
+        return self.midpoint('' if left is None else left, right)
+
+    def spread(self, left: typing.Optional[str], right: typing.Optional[str], count: int) -> typing.Optional[typing.List[str]]:
+        # between() only runs out if the neighbours are out of order, which respacing can't fix
+        return None
+
+    def midpoint(self, low: str, high: typing.Optional[str]) -> str:
+        # low is the empty string for zero and high is None for one
+        zero = self.alphabet[0]
+
+        if high is not None:
+            # Skip over any common prefix, padding low with zeros
+            n = 0
+
+            while n < len(high) and (low[n] if n < len(low) else zero) == high[n]:
+                n += 1
+
+            if n > 0:
+                return high[:n] + self.midpoint(low[n:], high[n:])
+
+        low_digit = self.reverse[low[0]] if low else 0
+        high_digit = self.reverse[high[0]] if high is not None else self.base
+
+        # There's a digit in between the first digits
+        if high_digit - low_digit > 1:
+            return self.alphabet[(low_digit + high_digit) // 2]
+
+        # The first digits are consecutive, so truncating high works if it's long enough
+        if high is not None and len(high) > 1:
+            return high[:1]
+
+        return self.alphabet[low_digit] + self.midpoint(low[1:], None)
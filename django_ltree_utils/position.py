@@ -22,9 +22,11 @@ class RelativePosition(models.TextChoices):
     # Or put back on manager or something
 
     @classmethod
-    def resolve(cls, kwargs, path_field: str, path_factory: PathFactory) -> typing.Tuple[Path, typing.Optional[int]]:
+    def resolve(cls, kwargs, path_field: str, path_factory: PathFactory) -> typing.Tuple[Path, typing.Optional[str]]:
         """ Parse kwargs and normalize relative position to always be
-        tuple = (parent_path, nth-child)
+        tuple = (parent_path, bound)
+        The node is placed immediately before the first sibling whose label is
+        greater than or equal to bound. A bound of None places the node last.
         """
         # Path field is used to unwrap/duck-type models that have a path attribute
         positions: typing.Dict['RelativePosition', typing.Any] = {}
@@ -59,14 +61,15 @@ class RelativePosition(models.TextChoices):
         if position in {cls.CHILD, cls.LAST_CHILD}:
             return relative_to, None
         elif position == cls.FIRST_CHILD:
-            return relative_to, 0
-        elif position in {cls.BEFORE, cls.AFTER}:
-            parent, child_index = path_factory.split(relative_to)
-
-            if position == cls.AFTER:
-                child_index += 1
-
-            return parent, child_index
+            # Every label sorts after the empty string
+            return relative_to, ''
+        elif position == cls.BEFORE:
+            *parent, label = relative_to
+            return parent, label
+        elif position == cls.AFTER:
+            *parent, label = relative_to
+            # Sorts after label, but before any label that sorted after it
+            return parent, label + path_factory.alphabet[0]
         else:
             # Should never get here
             raise Exception
@@ -78,9 +81,11 @@ class SortedPosition(models.TextChoices):
     ROOT = 'root', _("Root")
 
     @classmethod
-    def resolve(cls, kwargs, path_field: str, path_factory: PathFactory) -> typing.Tuple[Path, typing.Optional[int]]:
+    def resolve(cls, kwargs, path_field: str, path_factory: PathFactory) -> typing.Tuple[Path, typing.Optional[str]]:
         """ Parse kwargs and normalize relative position to always be
-        tuple = (parent_path, nth-child)
+        tuple = (parent_path, bound)
+        The node is placed immediately before the first sibling whose label is
+        greater than or equal to bound. A bound of None places the node last.
         """
         # Path field is used to unwrap/duck-type models that have a path attribute
         positions: typing.Dict['SortedPosition', typing.Any] = {}
@@ -115,8 +120,7 @@ class SortedPosition(models.TextChoices):
         if position == cls.CHILD:
             return relative_to, None
         elif position == cls.SIBLING:
-            parent, child_index = path_factory.split(relative_to)
-            return parent, None
+            return relative_to[:-1], None
         else:
             # Should never get here
             raise Exception
@@ -0,0 +1,60 @@
+import re
+
+from .paths import PathFactory
+
+
+# Raw SQL snippets mirroring PathFactory, so labels can be manipulated server-side
+# without round-tripping rows through Python
+# These only work for fixed-length labels, not FractionalPathFactory
+
+# Characters allowed in an ltree label
+# Anything in the alphabet is inlined into SQL, so this also guards against quoting problems
+LABEL_CHARACTERS = re.compile(r'^[A-Za-z0-9_]*$')
+
+# Unquoted identifiers, for the names of installed functions
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _alphabet(path_factory: PathFactory) -> str:
+    if not LABEL_CHARACTERS.match(path_factory.alphabet):
+        raise ValueError(f"Cannot use alphabet in SQL: {path_factory.alphabet!r}")
+
+    return f"'{path_factory.alphabet}'"
+
+
+def function_name(prefix: str, name: str) -> str:
+    """
+    Name of one of the label functions installed with the given prefix
+    See operations.CreateLabelFunctions
+    """
+    if not IDENTIFIER.match(prefix):
+        raise ValueError(f"Cannot use function prefix in SQL: {prefix!r}")
+
+    return f'{prefix}_{name}'
+
+
+def decode_sql(path_factory: PathFactory, label: str) -> str:
+    """
+    SQL expression for the integer value of label, which is a text expression
+    """
+    alphabet = _alphabet(path_factory)
+
+    # Sum of digit * radix, most significant digit first
+    return '(' + ' + '.join(
+        f"(strpos({alphabet}, substr({label}, {position}, 1)) - 1)::bigint * {path_factory.base ** exponent}"
+        for position, exponent in enumerate(reversed(range(path_factory.max_length)), start=1)
+    ) + ')'
+
+
+def encode_sql(path_factory: PathFactory, value: str) -> str:
+    """
+    SQL expression for the zero-padded label of value, which is an integer expression
+    Values that are too large wrap around instead of raising, so check them first
+    """
+    # mod() instead of the % operator, which would need escaping in parameterized queries
+    alphabet = _alphabet(path_factory)
+
+    return '(' + ' || '.join(
+        f"substr({alphabet}, mod(({value}) / {path_factory.base ** exponent}, {path_factory.base})::int + 1, 1)"
+        for exponent in reversed(range(path_factory.max_length))
+    ) + ')'
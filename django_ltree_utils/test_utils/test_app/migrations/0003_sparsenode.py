@@ -0,0 +1,36 @@
+# Generated by Django 3.1.14 on 2026-10-17 00:03
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.constraints
+import django_ltree_field.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0002_auto_20210401_2006'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SparseNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', django_ltree_field.fields.LTreeField(db_index=True)),
+                ('name', models.CharField(max_length=100)),
+            ],
+            options={
+                'ordering': ['path'],
+                'abstract': False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='sparsenode',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['path'], name='test_app_sp_path_e1d86d_gist'),
+        ),
+        migrations.AddConstraint(
+            model_name='sparsenode',
+            constraint=models.UniqueConstraint(deferrable=django.db.models.constraints.Deferrable['DEFERRED'], fields=('path',), name='test_app_sparsenode_unique_path_deferred'),
+        ),
+    ]
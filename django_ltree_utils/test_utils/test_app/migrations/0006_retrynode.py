@@ -0,0 +1,36 @@
+# Generated by Django 3.1.14 on 2026-10-17 00:45
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.constraints
+import django_ltree_field.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0005_lockednode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetryNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', django_ltree_field.fields.LTreeField(db_index=True)),
+                ('name', models.CharField(max_length=100)),
+            ],
+            options={
+                'ordering': ['path'],
+                'abstract': False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='retrynode',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['path'], name='test_app_re_path_53a0e7_gist'),
+        ),
+        migrations.AddConstraint(
+            model_name='retrynode',
+            constraint=models.UniqueConstraint(deferrable=django.db.models.constraints.Deferrable['DEFERRED'], fields=('path',), name='test_app_retrynode_unique_path_deferred'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.1.14 on 2026-10-17 00:51
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.constraints
+import django_ltree_field.fields
+import django_ltree_utils.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0006_retrynode'),
+    ]
+
+    operations = [
+        django_ltree_utils.operations.CreateLabelFunctions(),
+        migrations.CreateModel(
+            name='FunctionNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', django_ltree_field.fields.LTreeField(db_index=True)),
+                ('name', models.CharField(max_length=100)),
+            ],
+            options={
+                'ordering': ['path'],
+                'abstract': False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='functionnode',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['path'], name='test_app_fu_path_834cfc_gist'),
+        ),
+        migrations.AddConstraint(
+            model_name='functionnode',
+            constraint=models.UniqueConstraint(deferrable=django.db.models.constraints.Deferrable['DEFERRED'], fields=('path',), name='test_app_functionnode_unique_path_deferred'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.1.14 on 2026-10-17 01:07
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.constraints
+import django_ltree_field.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0008_cascadenode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoadNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', django_ltree_field.fields.LTreeField(db_index=True)),
+                ('name', models.CharField(max_length=100)),
+                ('tags', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=100, null=True), default=list, size=None)),
+                ('data', models.BinaryField(null=True)),
+                ('duration', models.DurationField(null=True)),
+            ],
+            options={
+                'ordering': ['path'],
+                'abstract': False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='loadnode',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['path'], name='test_app_lo_path_c0e969_gist'),
+        ),
+        migrations.AddConstraint(
+            model_name='loadnode',
+            constraint=models.UniqueConstraint(deferrable=django.db.models.constraints.Deferrable['DEFERRED'], fields=('path',), name='test_app_loadnode_unique_path_deferred'),
+        ),
+    ]
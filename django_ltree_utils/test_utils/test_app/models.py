@@ -1,7 +1,9 @@
+from django.contrib.postgres.fields import ArrayField
 from django.db import models
 
 from django_ltree_utils.managers import TreeManager
 from django_ltree_utils.models import AbstractNode
+from django_ltree_utils.paths import FractionalPathFactory, PathFactory
 
 
 class Category(AbstractNode):
@@ -20,3 +22,76 @@ class SortedNode(AbstractNode):
 
     def __str__(self):
         return self.name
+
+
+class SparseNode(AbstractNode):
+    name = models.CharField(max_length=100)
+
+    objects = TreeManager(
+        path_factory=PathFactory(stride=62)
+    )
+
+    def __str__(self):
+        return self.name
+
+
+class FractionalNode(AbstractNode):
+    name = models.CharField(max_length=100)
+
+    objects = TreeManager(
+        path_factory=FractionalPathFactory()
+    )
+
+    def __str__(self):
+        return self.name
+
+
+class LockedNode(AbstractNode):
+    name = models.CharField(max_length=100)
+
+    objects = TreeManager(
+        lock_parents=True
+    )
+
+    def __str__(self):
+        return self.name
+
+
+class RetryNode(AbstractNode):
+    name = models.CharField(max_length=100)
+
+    objects = TreeManager(
+        retries=3,
+        retry_backoff=0
+    )
+
+    def __str__(self):
+        return self.name
+
+
+class FunctionNode(AbstractNode):
+    name = models.CharField(max_length=100)
+
+    objects = TreeManager(
+        sql_functions='ltree_utils'
+    )
+
+    def __str__(self):
+        return self.name
+
+
+class CascadeNode(AbstractNode):
+    name = models.CharField(max_length=100)
+
+    def __str__(self):
+        return self.name
+
+
+class LoadNode(AbstractNode):
+    name = models.CharField(max_length=100)
+    tags = ArrayField(models.CharField(max_length=100, null=True), default=list)
+    data = models.BinaryField(null=True)
+    duration = models.DurationField(null=True)
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,75 @@
+import operator as op
+import typing
+
+
+class TreeNode:
+    """
+    Holds a row which can't have attributes set on it, such as the dicts and tuples
+    returned by values() and values_list(), along with its place in the tree
+    Attributes of the row (e.g. the fields of a named values_list() row) can be
+    accessed on the node directly
+    """
+    __slots__ = ('row', 'depth', 'children')
+
+    def __init__(self, row):
+        self.row = row
+
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails
+        # row isn't set yet while copying or unpickling, and copy and pickle look up
+        # special methods, which would recurse forever looking for row
+        if name == 'row' or (name.startswith('__') and name.endswith('__')):
+            raise AttributeError(name)
+
+        return getattr(self.row, name)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.row!r})'
+
+
+def tree_iterator(iterable,
+                  path_field: typing.Union[str, int, typing.Callable] = 'path',
+                  node_factory: typing.Optional[typing.Callable] = None) -> typing.Iterator:
+    """
+    Assemble rows into trees in a single pass, with a stack of the current node's ancestors
+    Rows must be in depth-first (path) order
+
+    path_field is an attribute name, a tuple index, or a callable returning a row's path
+    Every node gets depth and children attributes. Rows are used as nodes directly, unless
+    node_factory is given to wrap them (e.g. TreeNode)
+    Each root is yielded once its entire subtree has been read
+    """
+    if isinstance(path_field, str):
+        path_getter = op.attrgetter(path_field)
+    elif isinstance(path_field, int):
+        path_getter = op.itemgetter(path_field)
+    else:
+        path_getter = path_field
+
+    root = None
+    stack: typing.List = []
+
+    for row in iterable:
+        depth = len(path_getter(row))
+
+        node = row if node_factory is None else node_factory(row)
+
+        node.depth = depth
+        node.children = []
+
+        # Unwind to the parent
+        while stack and stack[-1].depth >= depth:
+            stack.pop()
+
+        if stack:
+            stack[-1].children.append(node)
+        else:
+            if root is not None:
+                yield root
+
+            root = node
+
+        stack.append(node)
+
+    if root is not None:
+        yield root
@@ -7,13 +7,37 @@ test_django-ltree-utils
 
 Tests for `django-ltree-utils` models module.
 """
+import copy
+import datetime
+import inspect
+import pickle
+import sys
+from unittest import mock
 
+from django.apps import apps as django_apps
+from django.db import IntegrityError, connection
+from django.db.migrations.state import ProjectState
+from django.db.models.signals import post_delete
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
-# from django_ltree_utils.test_utils.test_app.models import Category, SortedNode
+from django_ltree_utils.operations import CreateDeleteDescendantsTrigger, CreateLabelFunctions
+from django_ltree_utils.test_utils.test_app.models import (
+    CascadeNode, Category, FractionalNode, FunctionNode, LoadNode, LockedNode, RetryNode, SortedNode,
+    SparseNode
+)
 # from django_ltree_utils.utils import print_tree
 
 
+def names(queryset):
+    return [node.name for node in queryset.order_by('path')]
+
+
+def apps_state():
+    # Migration state with the test models, for running operations by hand
+    return ProjectState.from_apps(django_apps)
+
+
 class TestCategoryModel(TestCase):
 
     def setUp(self):
@@ -104,3 +128,1038 @@ class TestCategoryModel(TestCase):
 
     def tearDown(self):
         pass
+
+
+class TestRelativePosition(TestCase):
+
+    def setUp(self):
+        self.foo = Category.objects.create(root=True, name='Foo')
+        self.bar = Category.objects.create(child_of=self.foo, name='Bar')
+        self.qux = Category.objects.create(after=self.bar, name='Qux')
+
+    def test_before(self):
+        Category.objects.create(before=self.qux, name='Qur')
+
+        self.assertEqual(
+            names(Category.objects.filter(path__child_of=self.foo.path)),
+            ['Bar', 'Qur', 'Qux']
+        )
+
+    def test_first_child(self):
+        Category.objects.create(first_child_of=self.foo, name='First')
+
+        self.assertEqual(
+            names(Category.objects.filter(path__child_of=self.foo.path)),
+            ['First', 'Bar', 'Qux']
+        )
+
+    def test_shift(self):
+        Category.objects.create(child_of=self.bar, name='Bar child')
+
+        instance = Category(name='First')
+
+        moves = Category.objects._resolve_position(instance, {'before': self.bar})
+
+        # A single shift of the siblings, instead of one move per sibling
+        self.assertEqual(len(moves), 1)
+
+        Category.objects._bulk_move(moves)
+        instance.save()
+
+        self.assertEqual(
+            names(Category.objects.filter(path__child_of=self.foo.path)),
+            ['First', 'Bar', 'Qux']
+        )
+
+        # Descendants were shifted along with their parent
+        self.assertEqual(
+            names(Category.objects.filter(path__descendant_of=Category.objects.get(name='Bar').path)),
+            ['Bar', 'Bar child']
+        )
+
+    def test_move(self):
+        self.qux.move(before=self.bar)
+
+        self.assertEqual(
+            names(Category.objects.filter(path__child_of=self.foo.path)),
+            ['Qux', 'Bar']
+        )
+
+    def test_move_in_place(self):
+        # Leave a gap, so moving Last after Bar would otherwise close it
+        last = Category.objects.create(child_of=self.foo, name='Last')
+        self.qux.delete()
+
+        paths = list(Category.objects.values_list('path', flat=True))
+
+        for position in [{'after': self.bar}, {'child_of': self.foo}, {'before': last}]:
+            with CaptureQueriesContext(connection) as queries:
+                last.move(**position)
+
+            self.assertFalse([query for query in queries if query['sql'].lstrip().startswith('UPDATE')])
+
+        self.assertEqual(paths, list(Category.objects.values_list('path', flat=True)))
+
+    def test_invalid_position(self):
+        # Rejected before any transaction is opened, so the caller's transaction is still usable
+        with self.assertRaises(ValueError):
+            self.foo.move(child_of=self.bar)
+
+        self.assertEqual(Category.objects.count(), 3)
+
+        with self.assertRaises(ValueError):
+            Category.objects.create(root=False, name='X')
+
+        self.assertEqual(Category.objects.count(), 3)
+
+    def test_shift_sorted(self):
+        # Siblings sorted in Python are relabeled in order, but all of the siblings after
+        # the new one are moved by the same distance
+        Category.objects.create(child_of=self.foo, name='Quz')
+
+        with mock.patch.object(Category.objects, '_sort_key', lambda node: node.name):
+            instance = Category(name='Baz')
+
+            moves = Category.objects._resolve_position(instance, {'child_of': self.foo})
+
+            self.assertEqual(len(moves), 1)
+
+            Category.objects._bulk_move(moves)
+            instance.save()
+
+        self.assertEqual(
+            names(Category.objects.filter(path__child_of=self.foo.path)),
+            ['Bar', 'Baz', 'Qux', 'Quz']
+        )
+
+
+class TestSparseNode(TestCase):
+
+    def setUp(self):
+        self.root = SparseNode.objects.create(root=True, name='Root')
+
+        for name in ['A', 'B', 'C']:
+            SparseNode.objects.create(child_of=self.root, name=name)
+
+    def test_insert_between(self):
+        paths = dict(SparseNode.objects.values_list('name', 'path'))
+
+        a, b = SparseNode.objects.filter(name__in=['A', 'B']).order_by('path')
+
+        SparseNode.objects.create(after=a, name='AB')
+
+        self.assertEqual(
+            names(SparseNode.objects.filter(path__child_of=self.root.path)),
+            ['A', 'AB', 'B', 'C']
+        )
+
+        # Nothing else had to move
+        self.assertEqual(
+            paths,
+            dict(SparseNode.objects.exclude(name='AB').values_list('name', 'path'))
+        )
+
+    def test_exhausted_gap(self):
+        a = SparseNode.objects.get(name='A')
+
+        # Keep inserting directly in front of A until the gap runs out
+        for i in range(10):
+            a = SparseNode.objects.create(before=a, name=f'Before {i}')
+
+        self.assertEqual(
+            names(SparseNode.objects.filter(path__child_of=self.root.path)),
+            [f'Before {i}' for i in reversed(range(10))] + ['A', 'B', 'C']
+        )
+
+    def test_rebalance_window(self):
+        wide = SparseNode.objects.bulk_create({
+            'name': 'Wide',
+            'children': [{'name': f'{i}', 'children': [{'name': f'{i} child'}]} for i in range(100)]
+        }, root=True)
+
+        def rewritten(write):
+            # Rows other than the new ones whose paths changed
+            paths = dict(SparseNode.objects.values_list('name', 'path'))
+            write()
+            return sum(paths[name] != path for name, path in SparseNode.objects.values_list('name', 'path') if name in paths)
+
+        counts = []
+
+        # One at a time, then several at once, each in front of the others
+        for i in range(8):
+            counts.append(rewritten(lambda: SparseNode.objects.create(first_child_of=wide, name=f'First {i}')))
+
+        for i in range(4):
+            counts.append(rewritten(lambda: SparseNode.objects.bulk_create_branches([
+                ({'name': f'Branch {i} {j}'}, {'first_child_of': wide}) for j in range(2)
+            ])))
+
+        # The gaps ran out, but only a window of the siblings (and their children) was respaced,
+        # instead of all 100 of them
+        self.assertTrue(any(counts))
+        self.assertLess(max(counts), 100)
+
+        self.assertEqual(
+            names(SparseNode.objects.filter(path__child_of=wide.path)),
+            [f'Branch {i} {j}' for i in reversed(range(4)) for j in range(2)]
+            + [f'First {i}' for i in reversed(range(8))]
+            + [f'{i}' for i in range(100)]
+        )
+
+        for i in range(100):
+            self.assertEqual(SparseNode.objects.get(name=f'{i} child').path[:-1], SparseNode.objects.get(name=f'{i}').path)
+
+
+class TestFunctionNode(TestCase):
+
+    def setUp(self):
+        self.root = FunctionNode.objects.create(root=True, name='Root')
+
+        for name in ['A', 'B', 'C']:
+            FunctionNode.objects.create(child_of=self.root, name=name)
+
+    def test_functions(self):
+        factory = FunctionNode.objects.path_factory
+
+        with connection.cursor() as cursor:
+            for value, delta in [(0, 1), (61, 1), (62 ** 2 - 1, 1), (100, 62 ** 3)]:
+                cursor.execute(
+                    'SELECT ltree_utils_encode(%s), ltree_utils_decode(%s), ltree_utils_increment(%s, %s)',
+                    [value, factory.encode(value), factory.encode(value), delta]
+                )
+
+                self.assertEqual(
+                    cursor.fetchone(),
+                    (factory.encode(value), value, factory.encode(value + delta))
+                )
+
+            for path in [[], ['0001', '0002']]:
+                cursor.execute('SELECT ltree_utils_nth_child(%s::ltree, 62)', ['.'.join(path)])
+                self.assertEqual(cursor.fetchone()[0].split('.'), factory.nth_child(path, 62))
+
+    def test_sort(self):
+        FunctionNode.objects.filter(name='A').update(name='D')
+
+        with CaptureQueriesContext(connection) as queries:
+            FunctionNode.objects.sort('name', within=self.root)
+
+        self.assertTrue([query for query in queries if 'ltree_utils_nth_child(' in query['sql']])
+
+        self.assertEqual(
+            names(FunctionNode.objects.filter(path__child_of=self.root.path)),
+            ['B', 'C', 'D']
+        )
+
+    def test_shift(self):
+        a = FunctionNode.objects.get(name='A')
+
+        with CaptureQueriesContext(connection) as queries:
+            FunctionNode.objects.create(before=a, name='First')
+
+        self.assertTrue([query for query in queries if 'ltree_utils_increment(' in query['sql']])
+
+        self.assertEqual(
+            names(FunctionNode.objects.filter(path__child_of=self.root.path)),
+            ['First', 'A', 'B', 'C']
+        )
+
+    def test_reverse(self):
+        operation = CreateLabelFunctions()
+
+        def installed():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM pg_proc WHERE proname = 'ltree_utils_increment'")
+                return cursor.fetchone()[0]
+
+        with connection.schema_editor() as schema_editor:
+            operation.database_backwards('test_app', schema_editor, None, None)
+
+        self.assertEqual(installed(), 0)
+
+        with connection.schema_editor() as schema_editor:
+            operation.database_forwards('test_app', schema_editor, None, None)
+
+        self.assertEqual(installed(), 1)
+
+        with self.assertRaises(ValueError):
+            CreateLabelFunctions(prefix='ltree utils')
+
+
+class TestCascadeNode(TestCase):
+
+    def setUp(self):
+        for name in ['A', 'B']:
+            root = CascadeNode.objects.create(root=True, name=name)
+            child = CascadeNode.objects.create(child_of=root, name=f'{name}1')
+            CascadeNode.objects.create(child_of=child, name=f'{name}2')
+            CascadeNode.objects.create(child_of=root, name=f'{name}3')
+
+    def test_delete(self):
+        CascadeNode.objects.get(name='A1').delete()
+
+        self.assertEqual(names(CascadeNode.objects.all()), ['A', 'A3', 'B', 'B1', 'B2', 'B3'])
+
+        # Both subtrees with one statement, and the trigger's
+        with self.assertNumQueries(1):
+            CascadeNode.objects.filter(name__in=['A', 'B1']).delete()
+
+        self.assertEqual(names(CascadeNode.objects.all()), ['B', 'B3'])
+
+    def test_delete_from_trigger(self):
+        # Deletes issued by other triggers cascade as well
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TEMPORARY TABLE removal (name text)")
+            cursor.execute("""
+                CREATE FUNCTION pg_temp.remove_node() RETURNS trigger AS $$
+                BEGIN
+                    DELETE FROM test_app_cascadenode WHERE name = NEW.name;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            """)
+            cursor.execute("""
+                CREATE TRIGGER remove_node AFTER INSERT ON removal
+                FOR EACH ROW EXECUTE PROCEDURE pg_temp.remove_node()
+            """)
+            cursor.execute("INSERT INTO removal VALUES ('A1')")
+
+        self.assertEqual(names(CascadeNode.objects.all()), ['A', 'A3', 'B', 'B1', 'B2', 'B3'])
+
+    def test_reverse(self):
+        operation = CreateDeleteDescendantsTrigger('cascadenode')
+
+        with connection.schema_editor() as schema_editor:
+            operation.database_backwards('test_app', schema_editor, apps_state(), None)
+
+        CascadeNode.objects.get(name='A1').delete()
+
+        # The orphan is left behind
+        self.assertEqual(names(CascadeNode.objects.all()), ['A', 'A2', 'A3', 'B', 'B1', 'B2', 'B3'])
+
+        with connection.schema_editor() as schema_editor:
+            operation.database_forwards('test_app', schema_editor, None, apps_state())
+
+        CascadeNode.objects.get(name='B').delete()
+
+        self.assertEqual(names(CascadeNode.objects.all()), ['A', 'A2', 'A3'])
+
+
+class TestFractionalNode(TestCase):
+
+    def setUp(self):
+        self.root = FractionalNode.objects.create(root=True, name='Root')
+
+        for name in ['A', 'B']:
+            FractionalNode.objects.create(child_of=self.root, name=name)
+
+    def test_insert(self):
+        paths = dict(FractionalNode.objects.values_list('name', 'path'))
+
+        b = FractionalNode.objects.get(name='B')
+
+        # Always insert directly before the previously inserted node
+        for i in range(20):
+            b = FractionalNode.objects.create(before=b, name=f'Before {i}')
+
+        FractionalNode.objects.create(first_child_of=self.root, name='First')
+
+        self.assertEqual(
+            names(FractionalNode.objects.filter(path__child_of=self.root.path)),
+            ['First', 'A'] + [f'Before {i}' for i in reversed(range(20))] + ['B']
+        )
+
+        # No siblings were ever shifted
+        self.assertEqual(
+            paths,
+            dict(FractionalNode.objects.filter(name__in=paths).values_list('name', 'path'))
+        )
+
+
+class TestBulkCreate(TestCase):
+
+    def setUp(self):
+        self.root = Category.objects.create(root=True, name='Root')
+        Category.objects.create(child_of=self.root, name='Existing')
+
+    def test_bulk_create(self):
+        branch = Category.objects.bulk_create({
+            'name': 'Branch',
+            'children': [
+                {'name': 'One', 'children': [{'name': 'One One'}]},
+                {'name': 'Two'},
+            ]
+        }, first_child_of=self.root)
+
+        self.assertEqual(
+            names(Category.objects.filter(path__child_of=self.root.path)),
+            ['Branch', 'Existing']
+        )
+
+        self.assertEqual(
+            names(Category.objects.filter(path__descendant_of=branch.path)),
+            ['Branch', 'One', 'One One', 'Two']
+        )
+
+        # Paths on the returned nodes match the database
+        one_one = branch.children[0].children[0]
+
+        self.assertEqual(one_one.path, Category.objects.get(name='One One').path)
+
+    def test_bulk_create_branches(self):
+        existing = Category.objects.get(name='Existing')
+        other = Category.objects.create(root=True, name='Other')
+
+        # One snapshot of the siblings, one move to make room in front of Existing
+        # and one insert
+        with self.assertNumQueries(3):
+            roots = Category.objects.bulk_create_branches([
+                ({'name': 'Two', 'children': [{'name': 'Two One'}]}, {'child_of': self.root}),
+                ({'name': 'Zero'}, {'before': existing}),
+                ({'name': 'One'}, {'before': existing}),
+                ({'name': 'Other child'}, {'first_child_of': other}),
+            ])
+
+        self.assertEqual([root.name for root in roots], ['Two', 'Zero', 'One', 'Other child'])
+
+        self.assertEqual(
+            names(Category.objects.filter(path__child_of=self.root.path)),
+            ['Zero', 'One', 'Existing', 'Two']
+        )
+
+        self.assertEqual(
+            names(Category.objects.filter(path__descendant_of=other.path)),
+            ['Other', 'Other child']
+        )
+
+        self.assertEqual(roots[0].children[0].path, Category.objects.get(name='Two One').path)
+
+    def test_bulk_create_branches_relabel(self):
+        # No room in front of the first child, so the parent's children are relabeled,
+        # carrying along a branch grafted onto one of them
+        existing = Category.objects.get(name='Existing')
+
+        Category.objects.bulk_create_branches([
+            ({'name': 'Nested'}, {'child_of': existing}),
+            ({'name': 'First'}, {'first_child_of': self.root}),
+        ])
+
+        self.assertEqual(
+            names(Category.objects.filter(path__child_of=self.root.path)),
+            ['First', 'Existing']
+        )
+
+        self.assertEqual(
+            names(Category.objects.filter(path__child_of=Category.objects.get(name='Existing').path)),
+            ['Nested']
+        )
+
+    def test_batch_size(self):
+        # Passed through to QuerySet.bulk_create, the tree is still built up front
+        with CaptureQueriesContext(connection) as queries:
+            root = Category.objects.bulk_create({
+                'name': 'Batched',
+                'children': [{'name': f'Batched {i}'} for i in range(3)]
+            }, batch_size=2, child_of=self.root)
+
+        self.assertEqual(len(root.children), 3)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT')]), 2)
+
+    def test_chunk_size(self):
+        # Deep ltree paths are expensive to index, so keep this fairly shallow
+        # and lower the recursion limit instead
+        depth = 100
+
+        branch = {'name': 'Deep'}
+        node = branch
+
+        for i in range(depth):
+            node['children'] = [{'name': f'Deep {i}'}, {'name': f'Shallow {i}'}]
+            node = node['children'][0]
+
+        # Deeper than the recursion limit, with some room for the ORM
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(len(inspect.stack(0)) + depth // 2)
+
+        try:
+            root = Category.objects.bulk_create(branch, chunk_size=100, child_of=self.root)
+        finally:
+            sys.setrecursionlimit(limit)
+
+        self.assertEqual(
+            Category.objects.filter(path__descendant_of=root.path).count(),
+            2 * depth + 1
+        )
+
+        deepest = Category.objects.get(name=f'Deep {depth - 1}')
+
+        self.assertEqual(len(deepest.path), depth + 2)
+        self.assertEqual(
+            names(Category.objects.filter(path__sibling_of=deepest.path)),
+            [deepest.name, f'Shallow {depth - 1}']
+        )
+
+
+class TestBulkLoad(TestCase):
+
+    def setUp(self):
+        self.root = Category.objects.create(root=True, name='Root')
+        Category.objects.create(child_of=self.root, name='Existing')
+
+    def test_bulk_load(self):
+        def branches():
+            for i in range(3):
+                yield {
+                    'name': f'Branch {i}',
+                    'children': [{'name': f'Branch {i} child', 'children': [{'name': f'Branch {i} grandchild'}]}]
+                }
+
+        # Small chunks, so some of the rows are written with each COPY
+        self.assertEqual(Category.objects.bulk_load(branches(), chunk_size=4, child_of=self.root), 9)
+
+        self.assertEqual(
+            names(Category.objects.filter(path__child_of=self.root.path)),
+            ['Existing', 'Branch 0', 'Branch 1', 'Branch 2']
+        )
+
+        self.assertEqual(
+            [(node.name, len(node.path)) for node in Category.objects.filter(name__startswith='Branch 1')],
+            [('Branch 1', 2), ('Branch 1 child', 3), ('Branch 1 grandchild', 4)]
+        )
+
+    def test_analyze(self):
+        for analyze in [False, True]:
+            with CaptureQueriesContext(connection) as queries:
+                Category.objects.bulk_load([{'name': 'Loaded'}], analyze=analyze, child_of=self.root)
+
+            self.assertEqual(any(query['sql'].startswith('ANALYZE') for query in queries), analyze)
+
+    def test_roots(self):
+        Category.objects.bulk_load([{'name': 'Tab\tand\\backslash'}])
+
+        self.assertEqual(
+            names(Category.objects.filter(path__depth=1)),
+            ['Root', 'Tab\tand\\backslash']
+        )
+
+    def test_unknown_field(self):
+        with self.assertRaises(TypeError):
+            Category.objects.bulk_load([{'name': 'Root', 'colour': 'red'}])
+
+    def test_field_types(self):
+        tags = ['plain', 'with "quotes"', 'back\\slash', 'tab\tand, comma', None, '{braces}']
+        data = b'\x00\t\\binary'
+
+        LoadNode.objects.bulk_load([{
+            'name': 'Loaded', 'tags': tags, 'data': data, 'duration': datetime.timedelta(days=1, microseconds=5)
+        }])
+
+        node = LoadNode.objects.get(name='Loaded')
+
+        self.assertEqual(node.tags, tags)
+        self.assertEqual(bytes(node.data), data)
+        self.assertEqual(node.duration, datetime.timedelta(days=1, microseconds=5))
+
+        # Would otherwise be written as the repr of a set
+        with self.assertRaises(TypeError):
+            LoadNode.objects.bulk_load([{'name': 'Set', 'tags': {'a'}}])
+
+        self.assertFalse(LoadNode.objects.filter(name='Set').exists())
+
+
+class TestBulkMove(TestCase):
+
+    def setUp(self):
+        for name in ['A', 'B']:
+            root = Category.objects.create(root=True, name=name)
+            child = Category.objects.create(child_of=root, name=f'{name}1')
+            Category.objects.create(child_of=child, name=f'{name}2')
+
+    def assertSwapped(self):
+        self.assertEqual(
+            [(node.name, len(node.path)) for node in Category.objects.order_by('path')],
+            [('B', 1), ('B1', 2), ('B2', 3), ('A', 1), ('A1', 2), ('A2', 3)]
+        )
+
+    def swap(self, bulk_move):
+        a, b = Category.objects.filter(path__depth=1).order_by('path')
+
+        return bulk_move([
+            (a.path, b.path),
+            (b.path, a.path)
+        ])
+
+    def test_values(self):
+        self.assertEqual(self.swap(Category.objects._bulk_move_values), 6)
+        self.assertSwapped()
+
+    def test_case(self):
+        self.assertEqual(self.swap(Category.objects._bulk_move_case), 6)
+        self.assertSwapped()
+
+    def test_copy(self):
+        self.assertEqual(self.swap(Category.objects._bulk_move_copy), 6)
+        self.assertSwapped()
+
+    def test_nested(self):
+        # A1 leaves its parent, which goes to a new root, and A2 comes along with A1
+        for bulk_move in [
+            lambda moves: Category.objects._bulk_move_values(moves, nested=True),
+            Category.objects._bulk_move_case,
+            lambda moves: Category.objects._bulk_move_copy(moves, nested=True),
+        ]:
+            a, a1, b = Category.objects.filter(name__in=['A', 'A1', 'B']).order_by('path')
+            root = Category.objects.path_factory.nth_child([], 10)
+            child = Category.objects.path_factory.nth_child(b.path, 10)
+
+            self.assertEqual(bulk_move([
+                (a.path, root),
+                (a1.path, child)
+            ]), 3)
+
+            self.assertEqual(
+                [(node.name, len(node.path)) for node in Category.objects.order_by('path')],
+                [('B', 1), ('B1', 2), ('B2', 3), ('A1', 2), ('A2', 3), ('A', 1)]
+            )
+
+            # Put everything back
+            Category.objects._bulk_move([
+                (root, a.path),
+                (child, a1.path)
+            ])
+
+
+class TestMoveMany(TestCase):
+
+    def setUp(self):
+        for name in ['A', 'B', 'C']:
+            root = Category.objects.create(root=True, name=name)
+
+            for child in ['1', '2']:
+                child = Category.objects.create(child_of=root, name=f'{name}{child}')
+                Category.objects.create(child_of=child, name=f'{child.name} child')
+
+    def assertTree(self, tree):
+        self.assertEqual(
+            [(node.name, len(node.path)) for node in Category.objects.order_by('path')],
+            tree
+        )
+
+    def get(self, name):
+        return Category.objects.get(name=name)
+
+    def test_move_many(self):
+        a, c1, c2 = self.get('A'), self.get('C1'), self.get('C2')
+
+        # The siblings and the update
+        with self.assertNumQueries(2):
+            Category.objects.move_many([
+                (c2, {'first_child_of': a}),
+                (c1, {'first_child_of': a}),
+            ])
+
+        self.assertTree([
+            ('A', 1), ('C2', 2), ('C2 child', 3), ('C1', 2), ('C1 child', 3),
+            ('A1', 2), ('A1 child', 3), ('A2', 2), ('A2 child', 3),
+            ('B', 1), ('B1', 2), ('B1 child', 3), ('B2', 2), ('B2 child', 3),
+            ('C', 1),
+        ])
+
+        # In memory too
+        self.assertEqual(c1.path, self.get('C1').path)
+
+    def test_nested(self):
+        # A goes under B, which goes under C, while A's child goes to the root
+        # and B's child goes under A's child
+        Category.objects.move_many([
+            (self.get('A'), {'child_of': self.get('B')}),
+            (self.get('B'), {'child_of': self.get('C')}),
+            (self.get('A1'), {'root': True}),
+            (self.get('B2'), {'child_of': self.get('A1')}),
+        ])
+
+        self.assertTree([
+            ('C', 1), ('C1', 2), ('C1 child', 3), ('C2', 2), ('C2 child', 3),
+            ('B', 2), ('B1', 3), ('B1 child', 4),
+            ('A', 3), ('A2', 4), ('A2 child', 5),
+            ('A1', 1), ('A1 child', 2), ('B2', 2), ('B2 child', 3),
+        ])
+
+    def test_relabel(self):
+        # No room between A1 and A2, so A2 is relabeled while A1's child moves out from under A1
+        a1 = self.get('A1')
+
+        Category.objects.move_many([(self.get('A1 child'), {'after': a1})])
+
+        self.assertTree([
+            ('A', 1), ('A1', 2), ('A1 child', 2), ('A2', 2), ('A2 child', 3),
+            ('B', 1), ('B1', 2), ('B1 child', 3), ('B2', 2), ('B2 child', 3),
+            ('C', 1), ('C1', 2), ('C1 child', 3), ('C2', 2), ('C2 child', 3),
+        ])
+
+    def test_descendant(self):
+        a, a1, b = self.get('A'), self.get('A1'), self.get('B')
+
+        with self.assertRaises(ValueError):
+            Category.objects.move_many([(a, {'child_of': a1})])
+
+        # Only a cycle once both moves are done
+        with self.assertRaises(ValueError):
+            Category.objects.move_many([
+                (a, {'child_of': b}),
+                (b, {'child_of': a1}),
+            ])
+
+        with self.assertRaises(ValueError):
+            Category.objects.move_many([(a, {'child_of': b}), (a, {'root': True})])
+
+        # Rejected before any transaction is opened, so the caller's transaction is still usable
+        self.assertEqual(Category.objects.count(), 15)
+
+
+class TestSort(TestCase):
+
+    def setUp(self):
+        for name in ['C', 'A', 'B']:
+            root = Category.objects.create(root=True, name=name)
+
+            for child in ['2', '3', '1']:
+                Category.objects.create(child_of=root, name=f'{name}{child}')
+
+            Category.objects.create(child_of=Category.objects.get(name=f'{name}3'), name=f'{name}3 child')
+
+    def assertSorted(self):
+        self.assertEqual(
+            [(node.name, len(node.path)) for node in Category.objects.order_by('path')],
+            [
+                (name, depth)
+                for root in 'ABC'
+                for name, depth in [
+                    (root, 1), (f'{root}1', 2), (f'{root}2', 2), (f'{root}3', 2), (f'{root}3 child', 3)
+                ]
+            ]
+        )
+
+    def test_sort(self):
+        Category.objects.sort(lambda node: node.name)
+        self.assertSorted()
+
+    def test_sort_sql(self):
+        Category.objects.sort('name')
+        self.assertSorted()
+
+        # Already sorted, and gaps closed, so nothing left to do
+        self.assertEqual(Category.objects.sort('name'), 0)
+
+    def test_sort_within(self):
+        for key in ['name', lambda node: node.name]:
+            b = Category.objects.get(name='B')
+            paths = dict(Category.objects.exclude(path__descendant_of=b.path).values_list('name', 'path'))
+
+            Category.objects.sort(key, within=b)
+
+            self.assertEqual(
+                names(Category.objects.filter(path__descendant_of=b.path)),
+                ['B', 'B1', 'B2', 'B3', 'B3 child']
+            )
+
+            # Nothing else was touched
+            self.assertEqual(
+                paths,
+                dict(Category.objects.exclude(path__descendant_of=b.path).values_list('name', 'path'))
+            )
+
+            Category.objects.sort(lambda node: node.name[::-1], within=b)
+
+    def test_compact(self):
+        Category.objects.filter(name__in=['A2', 'B2']).delete()
+
+        Category.objects.compact(within=Category.objects.get(name='A'))
+
+        # Only the children of A were renumbered, the gap in front of B3 is still there
+        self.assertEqual(
+            [(node.name, node.path[-1]) for node in Category.objects.filter(path__depth=2).order_by('path')],
+            [
+                ('C2', '0000'), ('C3', '0001'), ('C1', '0002'),
+                ('A3', '0000'), ('A1', '0001'),
+                ('B3', '0001'), ('B1', '0002'),
+            ]
+        )
+
+        self.assertEqual(Category.objects.get(name='A3 child').path[:2], Category.objects.get(name='A3').path)
+
+    def test_compact_batches(self):
+        Category.objects.filter(name__in=['A2', 'B2']).delete()
+        Category.objects.filter(path__descendant_of=Category.objects.get(name='C').path).delete()
+
+        # Stop after the first batch, then pick up where it left off
+        batches = Category.objects.compact_batches(batch_size=2)
+        cursor = next(batches)
+        batches.close()
+
+        self.assertEqual(cursor, '0000')
+
+        cursors = list(Category.objects.compact_batches(batch_size=2, cursor=cursor))
+
+        self.assertEqual(len(cursors), 2)
+
+        self.assertEqual(
+            [(node.name, node.path) for node in Category.objects.order_by('path')],
+            [
+                ('A', ['0000']),
+                ('A3', ['0000', '0000']),
+                ('A3 child', ['0000', '0000', '0000']),
+                ('A1', ['0000', '0001']),
+                ('B', ['0001']),
+                ('B3', ['0001', '0000']),
+                ('B3 child', ['0001', '0000', '0000']),
+                ('B1', ['0001', '0001']),
+            ]
+        )
+
+
+class TestLockParents(TestCase):
+
+    def locks(self):
+        # Advisory locks held by this transaction (the whole test), by parent path
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT paths.path, locks.mode
+                FROM pg_locks AS locks
+                JOIN unnest(%s::text[]) AS paths (path) ON locks.objid = hashtext(paths.path)::oid
+                WHERE locks.locktype = 'advisory'
+                AND locks.pid = pg_backend_pid()
+                AND locks.classid = hashtext(%s)::oid
+            """, [
+                ['.'.join(node.path) for node in LockedNode.objects.all()] + [''],
+                LockedNode._meta.db_table
+            ])
+
+            return set(cursor.fetchall())
+
+    def test_create(self):
+        root = LockedNode.objects.create(root=True, name='Root')
+
+        self.assertEqual(self.locks(), {('', 'ExclusiveLock')})
+
+        child = LockedNode.objects.create(child_of=root, name='Child')
+        LockedNode.objects.create(child_of=child, name='Grandchild')
+
+        # Exclusive for the parents written to, shared for their ancestors
+        self.assertEqual(self.locks(), {
+            ('', 'ExclusiveLock'),
+            ('', 'ShareLock'),
+            ('.'.join(root.path), 'ExclusiveLock'),
+            ('.'.join(root.path), 'ShareLock'),
+            ('.'.join(child.path), 'ExclusiveLock'),
+        })
+
+
+class TestRetries(TestCase):
+
+    def setUp(self):
+        self.root = RetryNode.objects.create(root=True, name='Root')
+        self.child = RetryNode.objects.create(child_of=self.root, name='Child')
+
+        RetryNode.objects.stats.clear()
+
+    def collide(self, times):
+        # Resolve to the path of an existing node, like a concurrent writer got there first
+        resolve_at = RetryNode.objects._resolve_at
+        collisions = iter(range(times))
+
+        def _resolve_at(instance, parent, bound):
+            moves = resolve_at(instance, parent, bound)
+
+            if next(collisions, None) is not None:
+                instance.path = self.child.path
+
+            return moves
+
+        return mock.patch.object(RetryNode.objects, '_resolve_at', _resolve_at)
+
+    def test_retry(self):
+        with self.collide(2):
+            node = RetryNode.objects.create(child_of=self.root, name='Retried')
+
+        self.assertEqual(
+            names(RetryNode.objects.filter(path__child_of=self.root.path)),
+            ['Child', 'Retried']
+        )
+        self.assertEqual(node.path, RetryNode.objects.get(name='Retried').path)
+
+        self.assertEqual(RetryNode.objects.stats, {'attempts': 3, 'conflicts': 2, 'retries': 2})
+
+    def test_give_up(self):
+        with self.collide(4), self.assertRaises(IntegrityError):
+            RetryNode.objects.create(child_of=self.root, name='Failed')
+
+        self.assertEqual(RetryNode.objects.stats['failures'], 1)
+        self.assertFalse(RetryNode.objects.filter(name='Failed').exists())
+
+    def test_bulk_create(self):
+        with self.collide(1):
+            root = RetryNode.objects.bulk_create({
+                'name': 'Branch',
+                'children': [{'name': 'Branch child'}]
+            }, child_of=self.root)
+
+        self.assertEqual(
+            names(RetryNode.objects.filter(path__descendant_of=root.path)),
+            ['Branch', 'Branch child']
+        )
+        self.assertEqual(RetryNode.objects.stats['retries'], 1)
+
+    def test_bulk_create_branches(self):
+        # Allocate the path of an existing node the first time around
+        allocate = RetryNode.objects._allocate
+        collisions = iter(range(1))
+
+        def _allocate(parent, children, instances):
+            moves = allocate(parent, children, instances)
+
+            if next(collisions, None) is not None:
+                instances[0].path = self.child.path
+
+            return moves
+
+        with mock.patch.object(RetryNode.objects, '_allocate', _allocate):
+            roots = RetryNode.objects.bulk_create_branches([
+                ({'name': 'One', 'children': [{'name': 'One child'}]}, {'child_of': self.root}),
+                ({'name': 'Two'}, {'child_of': self.root}),
+            ])
+
+        self.assertEqual(
+            names(RetryNode.objects.filter(path__descendant_of=self.root.path)),
+            ['Root', 'Child', 'One', 'One child', 'Two']
+        )
+        self.assertEqual([root.path for root in roots], [
+            RetryNode.objects.get(name=name).path for name in ['One', 'Two']
+        ])
+        self.assertEqual(RetryNode.objects.stats, {'attempts': 2, 'conflicts': 1, 'retries': 1})
+
+
+class TestSortedNode(TestCase):
+
+    def setUp(self):
+        self.root = SortedNode.objects.create(root=True, name='Root')
+
+    def test_sorted(self):
+        for name in ['C', 'A', 'E', 'B', 'D', 'A']:
+            SortedNode.objects.create(child_of=self.root, name=name)
+
+        self.assertEqual(
+            names(SortedNode.objects.filter(path__child_of=self.root.path)),
+            ['A', 'A', 'B', 'C', 'D', 'E']
+        )
+
+    def test_neighbours(self):
+        for name in ['A'] + ['C'] * 10:
+            SortedNode.objects.create(child_of=self.root, name=name)
+
+        # No matter how many siblings there are: two neighbour lookups,
+        # checking the last sibling, shifting siblings and the insert
+        with self.assertNumQueries(5):
+            SortedNode.objects.create(child_of=self.root, name='B')
+
+        self.assertEqual(
+            names(SortedNode.objects.filter(path__child_of=self.root.path)),
+            ['A', 'B'] + ['C'] * 10
+        )
+
+
+class TestTreeQuerySet(TestCase):
+
+    def setUp(self):
+        for name in ['A', 'B']:
+            root = Category.objects.create(root=True, name=name)
+            child = Category.objects.create(child_of=root, name=f'{name}1')
+            Category.objects.create(child_of=child, name=f'{name}2')
+            Category.objects.create(child_of=root, name=f'{name}3')
+
+    def test_roots(self):
+        roots = list(Category.objects.all().roots(chunk_size=2))
+
+        self.assertEqual([root.name for root in roots], ['A', 'B'])
+        self.assertEqual([child.name for child in roots[1].children], ['B1', 'B3'])
+
+    def test_values_roots(self):
+        roots = list(Category.objects.values_list('name', 'path').roots())
+
+        self.assertEqual([root.row[0] for root in roots], ['A', 'B'])
+        self.assertEqual([child.row[0] for child in roots[0].children], ['A1', 'A3'])
+        self.assertEqual([child.row[0] for child in roots[0].children[0].children], ['A2'])
+
+        roots = list(Category.objects.values('name', 'path').roots())
+
+        self.assertEqual([child.row['name'] for child in roots[1].children], ['B1', 'B3'])
+
+    def test_as_tree(self):
+        roots = Category.objects.all().as_tree(fields=['id', 'name'])
+
+        self.assertEqual([root.name for root in roots], ['A', 'B'])
+        self.assertEqual([child.name for child in roots[0].children], ['A1', 'A3'])
+        self.assertEqual(roots[0].children[0].depth, 2)
+        self.assertEqual(roots[1].id, Category.objects.get(name='B').id)
+
+        # Ordered by path regardless of the queryset
+        roots = Category.objects.order_by('-name').as_tree(fields=['name'])
+
+        self.assertEqual([root.name for root in roots], ['A', 'B'])
+        self.assertEqual([child.name for child in roots[0].children], ['A1', 'A3'])
+
+        with self.assertRaises(ValueError):
+            Category.objects.all().as_tree(fields=['name', 'depth'])
+
+    def test_copy_tree(self):
+        root = Category.objects.all().as_tree(fields=['name'])[0]
+
+        for copied in [copy.copy(root), copy.deepcopy(root)]:
+            self.assertEqual(copied.name, 'A')
+            self.assertEqual([child.name for child in copied.children], ['A1', 'A3'])
+            self.assertEqual(copied.children[0].depth, 2)
+
+        # The named rows of as_tree() can't be pickled, plain tuples can
+        root = next(Category.objects.values_list('name', 'path').roots())
+        copied = pickle.loads(pickle.dumps(root))
+
+        self.assertEqual(copied.row, root.row)
+        self.assertEqual([child.row[0] for child in copied.children], ['A1', 'A3'])
+
+        with self.assertRaises(AttributeError):
+            copied.missing
+
+    def test_walk(self):
+        self.assertEqual(
+            [(depth, node.name) for depth, node in Category.objects.all().walk(chunk_size=2)],
+            [(1, 'A'), (2, 'A1'), (3, 'A2'), (2, 'A3'), (1, 'B'), (2, 'B1'), (3, 'B2'), (2, 'B3')]
+        )
+
+    def test_delete_subtrees(self):
+        deleted = []
+
+        def receiver(instance, **kwargs):
+            deleted.append(instance.name)
+
+        post_delete.connect(receiver, sender=Category)
+        self.addCleanup(post_delete.disconnect, receiver, sender=Category)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                Category.objects.filter(name__in=['A1', 'B']).delete_subtrees(),
+                (6, {'test_app.Category': 6})
+            )
+
+        self.assertEqual(deleted, [])
+        self.assertEqual(names(Category.objects.all()), ['A', 'A3'])
+
+        self.assertEqual(Category.objects.filter(name='A').delete_subtrees(signals=True)[0], 2)
+        self.assertEqual(sorted(deleted), ['A', 'A3'])
+        self.assertFalse(Category.objects.exists())
+
+    def test_delete_subtrees_empty(self):
+        for signals in [False, True]:
+            for queryset in [Category.objects.none(), Category.objects.filter(pk__in=[])]:
+                with self.assertNumQueries(0):
+                    self.assertEqual(queryset.delete_subtrees(signals=signals), (0, {'test_app.Category': 0}))
+
+        self.assertEqual(Category.objects.count(), 8)
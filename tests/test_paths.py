@@ -11,7 +11,7 @@ import itertools as it
 
 from django.test import TestCase
 
-from django_ltree_utils.paths import PathFactory
+from django_ltree_utils.paths import FractionalPathFactory, PathFactory
 
 
 class TestPathFactory(TestCase):
@@ -68,3 +68,119 @@ class TestPathFactory(TestCase):
                 ['A', 'B', '0005']
             ]
         )
+
+    def test_stride(self):
+        factory = PathFactory(stride=62)
+
+        self.assertEqual(
+            factory.nth_child([], 0),
+            ['000V']
+        )
+
+        self.assertEqual(
+            factory.nth_child([], 1),
+            ['001V']
+        )
+
+    def test_between(self):
+        factory = PathFactory()
+
+        self.assertEqual(factory.between('0002', '0004'), '0003')
+        self.assertEqual(factory.between('0002', None), '0003')
+        self.assertEqual(factory.between(None, None), '0000')
+
+        # No room left
+        self.assertIsNone(factory.between('0002', '0003'))
+        self.assertIsNone(factory.between(None, '0000'))
+
+        factory = PathFactory(stride=62)
+
+        self.assertEqual(factory.between('000V', None), '001V')
+        self.assertEqual(factory.between(None, '000V'), '000F')
+
+    def test_spread(self):
+        factory = PathFactory(stride=62)
+
+        self.assertEqual(factory.spread('0000', '0020', 2), ['000f', '001K'])
+        self.assertEqual(factory.spread(None, '0010', 1), ['000U'])
+
+        # Closer than half a stride
+        self.assertIsNone(factory.spread('0000', '0020', 4))
+
+        # Without a stride, every other label
+        self.assertEqual(PathFactory().spread('0002', '0008', 2), ['0004', '0006'])
+        self.assertIsNone(PathFactory().spread('0002', '0007', 2))
+
+    def test_dotted_children(self):
+        for factory in [PathFactory(), PathFactory(stride=62), FractionalPathFactory()]:
+            self.assertEqual(
+                factory.dotted_children(['A', 'B'], 70),
+                ['.'.join(factory.nth_child(['A', 'B'], n)) for n in range(70)]
+            )
+
+        self.assertEqual(PathFactory().dotted_children('A.B', 1), ['A.B.0000'])
+        self.assertEqual(PathFactory().dotted_children([], 1), ['0000'])
+
+    def test_round_trip(self):
+        for factory in [PathFactory(), PathFactory(max_length=3), PathFactory(alphabet='abc', max_length=5)]:
+            top = factory.base ** factory.max_length
+
+            for value in [0, 1, factory.base - 1, factory.base ** 2, top // 3, top - 1]:
+                label = factory.encode(value)
+
+                self.assertEqual(len(label), factory.max_length)
+                self.assertEqual(factory.decode(label), value)
+
+            with self.assertRaises(ValueError):
+                factory.encode(top)
+
+        # Padded with the first character of the alphabet
+        self.assertEqual(PathFactory(alphabet='abc', max_length=3).encode(1), 'aab')
+
+    def test_encode_range(self):
+        factory = PathFactory()
+
+        # Crosses a carry of the last two digits
+        values = range(62 ** 2 - 5, 62 ** 2 + 500, 3)
+
+        self.assertEqual(
+            list(factory.encode_range(values.start, values.stop, values.step)),
+            [factory.encode(value) for value in values]
+        )
+
+        with self.assertRaises(ValueError):
+            list(factory.encode_range(0, 62 ** 4 + 1))
+
+
+class TestFractionalPathFactory(TestCase):
+
+    def test_nth_child(self):
+        factory = FractionalPathFactory()
+
+        self.assertEqual(
+            [factory.nth_child([], n) for n in [0, 1, 61]],
+            [['0001'], ['0002'], ['001']]
+        )
+
+    def test_between(self):
+        factory = FractionalPathFactory()
+
+        self.assertEqual(factory.between('0001', '0002'), '0001V')
+        self.assertEqual(factory.between(None, '0001'), '0000V')
+        self.assertEqual(factory.between('0001', None), '0002')
+        self.assertEqual(factory.between('1', '2'), '1V')
+        self.assertEqual(factory.between('1', '12'), '11')
+
+        # Out of order
+        self.assertIsNone(factory.between('2', '1'))
+
+    def test_repeated_insert(self):
+        factory = FractionalPathFactory()
+
+        left, right = '0001', '0002'
+
+        for _ in range(100):
+            label = factory.between(left, right)
+            self.assertTrue(left < label < right)
+            self.assertFalse(label.endswith('0'))
+            right = label